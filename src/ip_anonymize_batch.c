@@ -0,0 +1,53 @@
+/*
+ * ip_anonymize_batch.c
+ * ====================
+ * Optional companion of ip_anonymize.py which anonymizes a whole
+ * array of IPv4 or IPv6 addresses in one call, instead of one ctypes
+ * call per address.
+ *
+ * scramble_ip4 and scramble_ip6 are passed in as function pointers, so the helper
+ * does not link against libcryptopANT and always uses the copy the
+ * script loaded and initialized with the key. unscramble_ip4 and
+ * unscramble_ip6 have the same signatures, so de-anonymization goes
+ * through the same loops.
+ *
+ * Build next to ip_anonymize.py:
+ *     cc -O2 -shared -fPIC -o ip_anonymize_batch.so ip_anonymize_batch.c
+ *
+ * Author: Sannan Tariq
+ * Email: stariq AT cs DOT cmu DOT edu
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+
+typedef uint32_t (*scramble_ip4_fn)(uint32_t input, int pass_bits);
+
+/*
+ * Anonymize count addresses from in into out, both in the byte
+ * order scramble_ip4 expects. ctypes releases the GIL around the
+ * call, so other Python threads keep running meanwhile.
+ */
+void scramble_ip4_many(scramble_ip4_fn scramble, const uint32_t *in,
+                       uint32_t *out, size_t count, int pass_bits)
+{
+    size_t i;
+
+    for (i = 0; i < count; i++)
+        out[i] = scramble(in[i], pass_bits);
+}
+
+typedef void (*scramble_ip6_fn)(void *input, int pass_bits);
+
+/*
+ * Anonymize count IPv6 addresses in place, addresses holds them as
+ * consecutive 16 byte struct in6_addr.
+ */
+void scramble_ip6_many(scramble_ip6_fn scramble, unsigned char *addresses,
+                       size_t count, int pass_bits)
+{
+    size_t i;
+
+    for (i = 0; i < count; i++)
+        scramble(addresses + 16 * i, pass_bits);
+}
@@ -0,0 +1,4710 @@
+"""
+ip_anonymize_core.py
+====================
+The core of the project
+which will be used to interface
+between the anonymization library
+and Splunk. It is run through
+ip_anonymize.py.
+
+Author: Sannan Tariq
+Email: stariq AT cs DOT cmu DOT edu
+"""
+
+import argparse
+import array
+import atexit
+import binascii
+import bisect
+import collections
+import csv
+import fcntl
+import hashlib
+import hmac
+import heapq
+import io
+import itertools
+import json
+import mmap
+import os
+import signal
+import stat
+import sys
+import ctypes
+import logging
+import re
+import socket
+import struct
+import threading
+import time
+
+# multiprocessing, subprocess, gzip, glob, getpass and tempfile are
+# imported where the commands need them, every lookup would pay for
+# them here
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+DISABLE_LOGGING = True
+LOG_NAME = 'IP_anon_plugin'
+LOG_FILE = '/var/tmp/%s.log' % LOG_NAME
+LOG_LEVEL = logging.ERROR
+
+# Environment variables enabling the log without changing the
+# command line, --log-file and --log-level take precedence
+LOG_FILE_ENV = 'IP_ANON_LOG_FILE'
+LOG_LEVEL_ENV = 'IP_ANON_LOG_LEVEL'
+
+# Number of records buffered before they are written when the
+# logging module has no QueueHandler (python 2)
+LOG_BUFFER_RECORDS = 1024
+
+# Default number of addresses kept in the in-process LRU cache
+DEFAULT_CACHE_SIZE = 65536
+
+# Default number of slots in the persistent cache file (12 bytes each)
+DEFAULT_CACHE_FILE_SLOTS = 1 << 20
+
+# Memory backed directory holding the cache file shared by all
+# lookup processes with --shared-cache, if the system has one
+SHARED_CACHE_DIR = '/dev/shm'
+
+# Unix domain socket of the resident anonymization daemon
+DEFAULT_SOCKET_PATH = '/var/tmp/%s.sock' % LOG_NAME
+DAEMON_CONNECT_TIMEOUT = 1.0
+
+# getsockopt option returning the pid, uid and gid of the process at
+# the other end of a Unix socket, missing from Python 2's socket module
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17 if sys.platform.startswith('linux') else None)
+
+# Every de-anonymization is recorded here before it runs
+DEFAULT_AUDIT_LOG = '/var/tmp/%s.audit.log' % LOG_NAME
+DAEMON_TIMEOUT = 60.0
+
+# Default number of rows whose addresses are deduplicated and
+# anonymized together
+DEFAULT_BATCH_SIZE = 10000
+
+# Default number of batches waiting between two pipeline stages
+DEFAULT_PIPELINE_DEPTH = 4
+
+# Companion helper anonymizing whole arrays, see ip_anonymize_batch.c
+DEFAULT_BATCH_LIB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'ip_anonymize_batch.so')
+
+# Largest number of addresses the table subcommand generates
+DEFAULT_TABLE_MAX_ADDRESSES = 1 << 24
+
+# Documents per KV store batch_save request (Splunk's default limit)
+KVSTORE_BATCH_SIZE = 1000
+
+# Environment variable holding the Splunk token for the KV store
+KVSTORE_TOKEN_ENV = 'SPLUNK_AUTH_TOKEN'
+
+# Number of slowest chunks kept by RunMetrics
+METRICS_SLOWEST_CHUNKS = 5
+
+# Columns the bulk command anonymizes unless told otherwise, the
+# Zeek names and the Splunk field names of the connection endpoints
+DEFAULT_BULK_FIELDS = ['id.orig_h', 'id.resp_h', 'id_orig_h', 'id_resp_h']
+DEFAULT_BULK_SUFFIX = '.anon'
+COMPRESSION_EXTENSIONS = ('.gz', '.zst')
+# json.loads returns unicode strings on Python 2
+JSON_STRING_TYPES = (str, type(u''))
+
+# What happens to field values which are not IP addresses
+ON_INVALID_ACTIONS = ('pass', 'blank', 'hash')
+DEFAULT_ON_INVALID = 'blank'
+
+# Dotted decimal IPv4 without leading zeros, which inet_aton would
+# read as octal
+IPV4_PATTERN = re.compile(
+    r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}'
+    r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\Z')
+IPV6_CANDIDATE = re.compile(r'[0-9A-Fa-f:.]*:[0-9A-Fa-f:.]*\Z')
+HOSTNAME_PATTERN = re.compile(
+    r'(?=[0-9.-]*[A-Za-z_])[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*\.?\Z')
+
+# Values Zeek and Splunk write for fields without a value
+PLACEHOLDER_VALUES = frozenset(['-', '(empty)', 'null', 'NULL', 'None', 'N/A', 'n/a'])
+
+
+# Configured by setup_logging, nothing is opened at import
+logger = logging.getLogger(LOG_NAME)
+logger.disabled = True
+logger.propagate = False
+
+# Handlers installed by setup_logging, see reset_logging
+_log_state = {}
+
+def _stop_logging():
+    for stop in _log_state.pop('stop', []):
+        stop()
+    for handler in _log_state.pop('handlers', []):
+        logger.removeHandler(handler)
+
+def setup_logging(log_file=None, log_level=None):
+    """
+    Configure the plugin log from the arguments, falling back to the
+    IP_ANON_LOG_FILE and IP_ANON_LOG_LEVEL environment variables and
+    then to DISABLE_LOGGING, LOG_FILE and LOG_LEVEL. Giving a file or
+    a level enables logging. Records go through a queue to a thread
+    writing the file (a memory buffer flushed on errors and at exit
+    on python 2), so logging never waits on the disk in the row loop.
+
+    :param log_file: string Path of the log file or None
+    :param log_level: string or int Level name or number or None
+
+    :return: None
+
+    .. warning:: Raises ValueError for an unknown level name
+    """
+    log_file = log_file or os.environ.get(LOG_FILE_ENV)
+    log_level = log_level or os.environ.get(LOG_LEVEL_ENV)
+    enabled = bool(log_file or log_level) or not DISABLE_LOGGING
+    level = log_level or LOG_LEVEL
+    if not isinstance(level, int):
+        level = logging.getLevelName(str(level).upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level: %s" % log_level)
+
+    _stop_logging()
+    _log_state['args'] = (log_file, log_level)
+    logger.disabled = not enabled
+    if not enabled:
+        return
+
+    # Only needed when logging is enabled, which it is not by default
+    from logging import handlers
+
+    # Opened on the first record that is actually written
+    file_handler = logging.FileHandler(log_file or LOG_FILE, delay=True)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    if hasattr(handlers, 'QueueHandler'):
+        records = queue.Queue(-1)
+        handler = handlers.QueueHandler(records)
+        listener = handlers.QueueListener(records, file_handler)
+        listener.start()
+        stop = [listener.stop, file_handler.close]
+    else:
+        handler = handlers.MemoryHandler(
+            LOG_BUFFER_RECORDS, logging.ERROR, file_handler)
+        stop = [handler.close, file_handler.close]
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    _log_state['handlers'] = [handler]
+    _log_state['stop'] = stop
+    logger.info("Python version info: %s", str(sys.version_info))
+
+def reset_logging():
+    """
+    Set the log up again in a forked process, whose copy of the
+    queue has no thread writing it out
+
+    :return: None
+    """
+    if 'args' in _log_state:
+        _log_state.pop('stop', None)
+        setup_logging(*_log_state['args'])
+
+atexit.register(_stop_logging)
+
+class ScrambleAlgo():
+    """
+    This is an enum containing the various scrambling
+    routines we can choose from.
+    """
+    SCRAMBLE_MD5 		= 0x01
+    SCRAMBLE_BLOWFISH 	= 0x02
+    SCRAMBLE_AES 		= 0x03
+    SCRAMBLE_SHA1		= 0x04
+
+def ip2long(ip_str):
+    """
+    Return the numerical representation of an IPv4 address string
+
+    :param ip_str: string IPv4 Address
+
+    :return: int Numerical Representation of IPv4 address
+
+    .. warning:: The behavior for invalid strings is undefined
+
+    .. seealso:: long2ip
+    """
+    return struct.unpack("!L", socket.inet_aton(ip_str))[0]
+
+def long2ip(num):
+    """
+    Return the string representation of a numerical IPv4 address
+
+    :param num: int Numerical Representation of IPv4 address
+
+    :return: string IPv4 Address
+
+    .. warning:: The behavior for invalid numbers is undefined
+
+    .. seealso:: ip2long
+    """
+    return socket.inet_ntoa(struct.pack('!L', num))
+
+# array typecode of an unsigned 32 bit integer
+UINT32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+def pack_ipv4_many(addresses):
+    """
+    Return the numerical representations of many IPv4 address
+    strings in the byte order the shared library expects, i.e.
+    swap32(ip2long(ip_str)) for each, converted in one pass
+
+    :param addresses: list of string IPv4 Addresses, or a bytes
+                    buffer of them separated by whitespace
+
+    :return: array.array of uint32
+
+    .. warning:: Raises socket.error for invalid strings
+
+    .. seealso:: unpack_ipv4_many
+    """
+    if isinstance(addresses, bytes) and not isinstance(addresses, str):
+        addresses = addresses.decode('ascii').split()
+    elif isinstance(addresses, bytes):
+        addresses = addresses.split()
+    values = array.array(UINT32_TYPECODE, b''.join(map(socket.inet_aton, addresses)))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def unpack_ipv4_many(values):
+    """
+    Return the IPv4 address strings of many numerical addresses in
+    the byte order the shared library uses, i.e.
+    long2ip(swap32(value)) for each, converted in one pass
+
+    :param values: array.array of uint32 or list of int
+
+    :return: list of string IPv4 Addresses
+
+    .. seealso:: pack_ipv4_many
+    """
+    if sys.byteorder == 'big' or not isinstance(values, array.array) \
+            or values.typecode != UINT32_TYPECODE:
+        values = array.array(UINT32_TYPECODE, values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    data = values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+    # Split into 4 byte strings in one call rather than slicing
+    return list(map(socket.inet_ntoa, struct.unpack('4s' * len(values), data)))
+
+def pack_ipv6_many(addresses):
+    """
+    Return the 16 byte packed forms of many IPv6 address strings,
+    concatenated, the layout of an array of struct in6_addr
+
+    :param addresses: list of string IPv6 Addresses
+
+    :return: bytes of 16 bytes per address
+
+    .. warning:: Raises socket.error for invalid strings
+
+    .. seealso:: unpack_ipv6_many
+    """
+    inet_pton = socket.inet_pton
+    return b''.join([inet_pton(socket.AF_INET6, a) for a in addresses])
+
+def unpack_ipv6_many(data):
+    """
+    Return the IPv6 address strings, in canonical compressed form,
+    of concatenated 16 byte packed addresses
+
+    :param data: bytes of 16 bytes per address
+
+    :return: list of string IPv6 Addresses
+
+    .. seealso:: pack_ipv6_many
+    """
+    inet_ntop = socket.inet_ntop
+    return [inet_ntop(socket.AF_INET6, packed)
+            for packed in struct.unpack('16s' * (len(data) // 16), data)]
+
+def swap32(x):
+    """
+    Return the input in reversed byte order
+
+    :param x: int The input you want to flip the byte order of
+
+    :return: int x but with its byte order flipped
+    """
+    return (((x << 24) & 0xFF000000) |
+            ((x <<  8) & 0x00FF0000) |
+            ((x >>  8) & 0x0000FF00) |
+            ((x >> 24) & 0x000000FF))
+
+def create_init_fun(lib):
+    """
+    Return the initialization function for the DLL
+
+    :param lib: ctypes.cdll object loaded using ctypes.cdll.LoadLibrary
+
+    :return: python function to invoke the library initialization
+    """
+    init_fun = lib.scramble_init_from_file
+    init_fun.restype = ctypes.c_int
+    init_fun.argtypes = [ctypes.c_char_p, ctypes.c_uint, 
+                            ctypes.c_uint, ctypes.POINTER(ctypes.c_int)]
+    return init_fun
+
+def create_anonymize_fun(lib):
+    """
+    Return the anonymization function from the DLL
+
+    :param lib: ctypes.cdll object loaded using ctypes.cdll.LoadLibrary
+
+    :return: python function to invoke the anonymization routine
+    """
+    anonymize = lib.scramble_ip4
+    anonymize.restype = ctypes.c_int32
+    anonymize.argtypes = [ctypes.c_uint32, ctypes.c_int]
+    return anonymize
+
+def create_anonymize6_fun(lib):
+    """
+    Return the IPv6 anonymization function from the DLL, which
+    scrambles a struct in6_addr in place
+
+    :param lib: ctypes.cdll object loaded using ctypes.cdll.LoadLibrary
+
+    :return: python function to invoke the anonymization routine
+    """
+    anonymize = lib.scramble_ip6
+    anonymize.restype = None
+    anonymize.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    return anonymize
+
+def create_deanonymize_fun(lib):
+    """
+    Return the inverse of the anonymization function from the DLL,
+    it has the signature of scramble_ip4
+
+    :param lib: ctypes.cdll object loaded using ctypes.cdll.LoadLibrary
+
+    :return: python function to invoke the de-anonymization routine
+    """
+    deanonymize = lib.unscramble_ip4
+    deanonymize.restype = ctypes.c_int32
+    deanonymize.argtypes = [ctypes.c_uint32, ctypes.c_int]
+    return deanonymize
+
+def create_deanonymize6_fun(lib):
+    """
+    Return the inverse of the IPv6 anonymization function from the
+    DLL, which unscrambles a struct in6_addr in place
+
+    :param lib: ctypes.cdll object loaded using ctypes.cdll.LoadLibrary
+
+    :return: python function to invoke the de-anonymization routine
+    """
+    deanonymize = lib.unscramble_ip6
+    deanonymize.restype = None
+    deanonymize.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    return deanonymize
+
+def create_batch6_fun(batch_lib):
+    """
+    Return the IPv6 batch anonymization function of the companion
+    helper
+
+    :param batch_lib: ctypes.cdll object of ip_anonymize_batch.so
+
+    :return: python function to invoke scramble_ip6_many
+    """
+    batch = batch_lib.scramble_ip6_many
+    batch.restype = None
+    batch.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+    return batch
+
+def create_batch_fun(batch_lib):
+    """
+    Return the batch anonymization function of the companion helper
+
+    :param batch_lib: ctypes.cdll object of ip_anonymize_batch.so
+
+    :return: python function to invoke scramble_ip4_many
+    """
+    batch = batch_lib.scramble_ip4_many
+    batch.restype = None
+    batch.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                      ctypes.c_size_t, ctypes.c_int]
+    return batch
+
+class NativeAnonymizeFunction(object):
+    """
+    The library's scramble_ip4 and scramble_ip6 with ``many`` and
+    ``many6`` methods. With the companion helper a whole array is
+    handed over and looped over in C: one ctypes call per batch
+    instead of one per address, and the GIL is released while it
+    runs. Without it the methods call the library per address.
+    """
+
+    def __init__(self, anonymize, batch=None, anonymize6=None, batch6=None):
+        """
+        :param anonymize: python function from create_anonymize_fun
+        :param batch: python function from create_batch_fun or None
+        :param anonymize6: python function from create_anonymize6_fun
+                        or None if the library has no IPv6 support
+        :param batch6: python function from create_batch6_fun or None
+        """
+        self.anonymize = anonymize
+        self.batch = batch
+        self.anonymize6 = anonymize6
+        self.batch6 = batch6
+        self._scramble = ctypes.cast(anonymize, ctypes.c_void_p)
+        if anonymize6 is not None:
+            self._scramble6 = ctypes.cast(anonymize6, ctypes.c_void_p)
+            self.many6 = self._many6
+
+    def __call__(self, reversed_bytes, pass_bits):
+        return self.anonymize(reversed_bytes, pass_bits)
+
+    def many(self, reversed_values, pass_bits):
+        """
+        Anonymize many addresses in one call into the helper
+
+        :param reversed_values: array.array of uint32 or list of int
+                            addresses in the byte order scramble_ip4
+                            expects
+        :param pass_bits: int Number of leading bits left untouched
+
+        :return: array.array of uint32 anonymized addresses in the
+                same byte order
+        """
+        if self.batch is None:
+            return [self.anonymize(v, pass_bits) & 0xFFFFFFFF for v in reversed_values]
+        if not isinstance(reversed_values, array.array) \
+                or reversed_values.typecode != UINT32_TYPECODE:
+            reversed_values = array.array(UINT32_TYPECODE, reversed_values)
+        count = len(reversed_values)
+        anonymized = array.array(UINT32_TYPECODE, [0]) * count
+        if count:
+            self.batch(self._scramble, reversed_values.buffer_info()[0],
+                       anonymized.buffer_info()[0], count, pass_bits)
+        return anonymized
+
+    def _many6(self, packed, pass_bits):
+        """
+        Anonymize many IPv6 addresses
+
+        :param packed: bytes from pack_ipv6_many
+        :param pass_bits: int Number of leading bits left untouched
+
+        :return: bytes anonymized addresses in the same layout
+        """
+        count = len(packed) // 16
+        buf = ctypes.create_string_buffer(packed, len(packed))
+        if self.batch6 is not None:
+            self.batch6(self._scramble6, buf, count, pass_bits)
+        else:
+            for i in range(count):
+                self.anonymize6(ctypes.byref(buf, 16 * i), pass_bits)
+        return buf.raw
+
+def anonymize_ipv4(anonymize_function, ip4_str):
+    """
+    Return the prefix-preserved  anonymized string representation
+     of the IPv4 address string
+
+    :param anonymize_function: python function to invoke shared 
+                            library anonymization routine
+    :param ip4_str: string IPv4 Address string
+
+    :return: string IPv4 prefix preserved anonymized string
+    """
+
+    # Specify how many bits to scramble in IP Address
+    BITS_TO_SCRAMBLE = 32
+    assert(BITS_TO_SCRAMBLE <= 32)
+    assert(BITS_TO_SCRAMBLE >= 0)
+
+    # Create 32 bit mask to and with output
+    mask = (1 << 32) - 1
+
+    # Convert string to numerical representation and reverse byte order
+    reversed_bytes = swap32(ip2long(ip4_str))
+
+    # Get anonymized numerical representation from Shared Library function
+    anonymized_result = (anonymize_function(
+        reversed_bytes, 32 - BITS_TO_SCRAMBLE) & mask)
+
+    # Reverse byte order and convert back to IPv4 string
+    return long2ip(swap32(anonymized_result))
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used
+    entry once it holds more than capacity entries. It keeps
+    hit, miss and eviction counters so we can log how well
+    it performs on a given lookup.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: int Maximum number of entries to hold,
+                        0 disables the cache entirely
+        """
+        assert(capacity >= 0)
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the value cached for key and mark it as most
+        recently used
+
+        :param key: hashable Lookup key
+
+        :return: cached value or None if key is not present
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Insert value for key, evicting the least recently used
+        entry if the cache is full
+
+        :param key: hashable Lookup key
+        :param value: Value to cache for key
+
+        :return: None
+        """
+        if self.capacity == 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats_str(self):
+        """
+        Return a one line summary of the cache counters, meant
+        for the log file
+
+        :return: string
+        """
+        lookups = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        return "size=%d/%d hits=%d misses=%d evictions=%d hit_rate=%.1f%%" % (
+            len(self._entries), self.capacity, self.hits, self.misses,
+            self.evictions, hit_rate)
+
+def anonymize_ipv4_many(anonymize_function, addresses, cache):
+    """
+    Return the anonymized strings for a list of IPv4 address
+    strings, consulting cache first. The cache misses are converted
+    with pack_ipv4_many and unpack_ipv4_many, and if
+    anonymize_function has a ``many`` method they go to it in a
+    single call.
+
+    :param anonymize_function: python function to invoke shared
+                            library anonymization routine
+    :param addresses: list of string IPv4 Addresses
+    :param cache: LRUCache mapping raw address strings to
+                anonymized address strings
+
+    :return: list of string IPv4 prefix preserved anonymized strings
+
+    .. seealso:: anonymize_ipv4
+    """
+    many = getattr(anonymize_function, 'many', None)
+    if many is None:
+        many = lambda values, pass_bits: [anonymize_function(v, pass_bits) for v in values]
+
+    results = [cache.get(a) for a in addresses]
+    missing = [i for i, result in enumerate(results) if result is None]
+    anonymized = many(pack_ipv4_many([addresses[i] for i in missing]), 0)
+    if not isinstance(anonymized, array.array):
+        anonymized = [value & 0xFFFFFFFF for value in anonymized]
+    anonymized = unpack_ipv4_many(anonymized)
+    for i, result in zip(missing, anonymized):
+        results[i] = result
+        cache.put(addresses[i], result)
+    return results
+
+class UnsupportedFamilyError(ValueError):
+    """
+    Raised when the library has no scramble_ip6 for IPv6 addresses
+    """
+
+def anonymize_ipv6_many(anonymize_function, addresses, cache):
+    """
+    Return the anonymized strings for a list of IPv6 address
+    strings. The cache is keyed on the 16 byte packed address, so
+    different spellings of an address share an entry, and all cache
+    misses go to the ``many6`` method of anonymize_function at once.
+
+    :param anonymize_function: anonymization function with a
+                            ``many6`` method
+    :param addresses: list of string IPv6 Addresses
+    :param cache: LRUCache, shared with IPv4 address strings which
+                can never be 16 characters long
+
+    :return: list of string IPv6 prefix preserved anonymized strings
+            in canonical compressed form
+
+    .. warning:: Raises UnsupportedFamilyError if anonymize_function
+                has no IPv6 support
+    """
+    packed = [socket.inet_pton(socket.AF_INET6, a) for a in addresses]
+    results = [cache.get(p) for p in packed]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        many6 = getattr(anonymize_function, 'many6', None)
+        if many6 is None:
+            raise UnsupportedFamilyError("The anonymization library does not support IPv6")
+        anonymized = unpack_ipv6_many(many6(b''.join([packed[i] for i in missing]), 0))
+        for i, result in zip(missing, anonymized):
+            results[i] = result
+            cache.put(packed[i], result)
+    return results
+
+def anonymize_ip_many(anonymize_function, addresses, cache):
+    """
+    Return the anonymized strings for a list of IPv4 and IPv6
+    address strings, each family going through its own batch
+
+    :param anonymize_function: python function to invoke shared
+                            library anonymization routine
+    :param addresses: list of string IPv4 or IPv6 Addresses
+    :param cache: LRUCache
+
+    :return: list of string prefix preserved anonymized strings
+
+    .. seealso:: anonymize_ipv4_many, anonymize_ipv6_many
+    """
+    v6 = [i for i, a in enumerate(addresses) if ':' in a]
+    if not v6:
+        return anonymize_ipv4_many(anonymize_function, addresses, cache)
+    if len(v6) == len(addresses):
+        return anonymize_ipv6_many(anonymize_function, addresses, cache)
+
+    results = [None] * len(addresses)
+    v4 = [i for i, a in enumerate(addresses) if ':' not in a]
+    for indices, anonymize_many in ((v4, anonymize_ipv4_many), (v6, anonymize_ipv6_many)):
+        anonymized = anonymize_many(anonymize_function, [addresses[i] for i in indices], cache)
+        for i, result in zip(indices, anonymized):
+            results[i] = result
+    return results
+
+def key_fingerprint(key_file_path, scramble_algo):
+    """
+    Return a digest identifying the key file contents together
+    with the scrambling algorithm. Anonymized results are only
+    valid for the exact key and algorithm that produced them.
+
+    :param key_file_path: string Path to the key file
+    :param scramble_algo: enum value The algorithm used for scrambling
+
+    :return: bytes SHA-1 digest
+    """
+    digest = hashlib.sha1()
+    with open(key_file_path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(('|%d' % scramble_algo).encode())
+    return digest.digest()
+
+class AnonymizationTable(object):
+    """
+    A fixed size open addressing hash table from uint32 input to
+    uint32 output stored in a memory mapped file, so results
+    survive between lookup invocations.
+
+    The file starts with a header holding a magic string, the
+    slot count, the key fingerprint and a generation. If any of
+    those do not match what the caller expects, the table is wiped
+    and started over: in place with a new generation if only the
+    fingerprint differs, otherwise by renaming a new file over it,
+    so the file never shrinks under a process which has it mapped.
+    Each slot is (state, key, value), where state is written last
+    so a reader never sees a half written entry. Writers hold an
+    exclusive flock on the file and check the header first, readers
+    check the generation around every lookup. A process whose key
+    no longer matches the header stops using the table.
+
+    The rest of the header holds hit, miss and collision counters
+    summed over every process which used the table, each process
+    adding its own when it closes the table. A collision is a probe
+    that found a slot holding another key.
+    """
+
+    MAGIC = b'IPAT'
+    VERSION = 3
+    HEADER = struct.Struct('<4sIII20sI')
+    HEADER_SIZE = 64
+    COUNT_OFFSET = 12
+    FINGERPRINT_OFFSET = 16
+    GENERATION_OFFSET = 36
+    SHARED_STATS = struct.Struct('<QQQ')
+    SHARED_STATS_OFFSET = 40
+    SLOT = struct.Struct('<III')
+    ENTRY = struct.Struct('<II')
+    WORD = struct.Struct('<I')
+    SLOT_USED = 1
+    MAX_PROBES = 16
+    MAX_LOAD = 0.75
+
+    def __init__(self, path, fingerprint, slots=DEFAULT_CACHE_FILE_SLOTS):
+        """
+        :param path: string Path of the table file (created if missing)
+        :param fingerprint: bytes Digest from key_fingerprint
+        :param slots: int Number of slots, must be a power of two
+        """
+        assert(slots > 0 and slots & (slots - 1) == 0), "slots must be a power of two"
+        self.path = path
+        self.fingerprint = fingerprint
+        self.slots = slots
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.dropped = 0
+        self.collisions = 0
+        self.stale = False
+        self._flushed = (0, 0, 0)
+        self._mask = slots - 1
+        self._shift = 32 - (slots.bit_length() - 1)
+        self._size = self.HEADER_SIZE + slots * self.SLOT.size
+
+        while True:
+            fd = self._open(path, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if self._is_current(fd) and self._prepare(fd):
+                    break
+            except BaseException:
+                os.close(fd)
+                raise
+            # Replaced by another process while we waited for the lock
+            os.close(fd)
+        self._fd = fd
+        try:
+            self._map = mmap.mmap(fd, self._size)
+            self._generation = self._read_generation()
+            self._count = self._read_count()
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _open(path, flags):
+        """
+        Open a table file readable by the current user only. Symbolic
+        links are not followed and a file of another user is refused,
+        since the table maps every address it holds to its pseudonym.
+
+        :param path: string Path of the file
+        :param flags: int os.open flags
+
+        :return: int File descriptor
+
+        .. warning:: Raises OSError if the file cannot be opened or
+                    belongs to another user
+        """
+        fd = os.open(path, flags | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            info = os.fstat(fd)
+            if info.st_uid != os.getuid():
+                raise OSError("%s belongs to uid %d, not %d" % (path, info.st_uid, os.getuid()))
+            if info.st_mode & 0o077:
+                # Created by an older version
+                os.fchmod(fd, 0o600)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    def _is_current(self, fd):
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            return False
+        opened = os.fstat(fd)
+        return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+    def _prepare(self, fd):
+        """
+        Make the locked file fd a valid table for this key
+
+        :return: bool False if the file was replaced and has to be
+                opened again
+        """
+        if os.fstat(fd).st_size != self._size:
+            logger.info("Recreating anonymization table %s", self.path)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            tmp_fd = self._open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            try:
+                os.ftruncate(tmp_fd, self._size)
+                self._write_header(tmp_fd, 0)
+            finally:
+                os.close(tmp_fd)
+            os.rename(tmp_path, self.path)
+            return False
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        magic, version, slots, _, fingerprint, generation = self.HEADER.unpack(
+            os.read(fd, self.HEADER.size))
+        if (magic != self.MAGIC or version != self.VERSION or slots != self.slots or
+                fingerprint != self.fingerprint):
+            logger.info("Resetting anonymization table %s", self.path)
+            # Processes mapping the table stop using it before any
+            # slot changes, and only take it up again once every
+            # slot is empty
+            self._write_header(fd, (generation + 1) & 0xFFFFFFFF, b'\0' * len(fingerprint))
+            zeros = b'\0' * (1 << 20)
+            remaining = self._size - self.HEADER_SIZE
+            while remaining:
+                remaining -= os.write(fd, zeros[:min(remaining, len(zeros))])
+            self._write_header(fd, (generation + 2) & 0xFFFFFFFF)
+        return True
+
+    def _write_header(self, fd, generation, fingerprint=None):
+        os.lseek(fd, 0, os.SEEK_SET)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.slots, 0,
+                                  fingerprint or self.fingerprint, generation)
+        os.write(fd, header.ljust(self.HEADER_SIZE, b'\0'))
+
+    def _read_count(self):
+        return self.WORD.unpack_from(self._map, self.COUNT_OFFSET)[0]
+
+    def _read_generation(self):
+        return self.WORD.unpack_from(self._map, self.GENERATION_OFFSET)[0]
+
+    def _check_header(self):
+        """
+        Follow a reset of the table by another process. Caller should
+        hold the lock unless only reading.
+
+        :return: bool True if the table currently belongs to this key
+        """
+        generation = self._read_generation()
+        if generation == self._generation:
+            return not self.stale
+        start = self.FINGERPRINT_OFFSET
+        stale = self._map[start:start + len(self.fingerprint)] != self.fingerprint
+        if stale and not self.stale:
+            logger.warning("Anonymization table %s was reset for another key, "
+                           "not using it until it is reset for ours", self.path)
+        self.stale = stale
+        self._generation = generation
+        self._count = self._read_count()
+        return not stale
+
+    def _offset(self, key, probe):
+        # Multiplicative hashing spreads neighbouring addresses apart.
+        # The index comes from the high bits of the product, the low
+        # ones only depend on the low bits of the key, which is the
+        # first octet in the byte order of scramble_ip4.
+        index = ((((key * 2654435761) & 0xFFFFFFFF) >> self._shift) + probe) & self._mask
+        return self.HEADER_SIZE + index * self.SLOT.size
+
+    def __len__(self):
+        return self._count
+
+    def get(self, key):
+        """
+        Return the value stored for key
+
+        :param key: int uint32 key
+
+        :return: int uint32 value or None if key is not present
+        """
+        if not self._check_header():
+            self.misses += 1
+            return None
+        unpack_from = self.SLOT.unpack_from
+        for probe in range(self.MAX_PROBES):
+            state, slot_key, value = unpack_from(self._map, self._offset(key, probe))
+            if state != self.SLOT_USED:
+                break
+            if slot_key == key:
+                # A reset meanwhile may have handed the slot to another key
+                if self._read_generation() != self._generation:
+                    break
+                self.hits += 1
+                self.collisions += probe
+                return value
+        self.misses += 1
+        self.collisions += probe
+        return None
+
+    def put(self, key, value):
+        """
+        Store value for key. The entry is silently dropped if the
+        table is too full or the probe sequence is exhausted.
+
+        :param key: int uint32 key
+        :param value: int uint32 value
+
+        :return: None
+        """
+        if self._count >= self.slots * self.MAX_LOAD:
+            self.dropped += 1
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if not self._check_header():
+                self.dropped += 1
+                return
+            # Other processes may have inserted since we last looked
+            self._count = self._read_count()
+            for probe in range(self.MAX_PROBES):
+                offset = self._offset(key, probe)
+                state, slot_key, _ = self.SLOT.unpack_from(self._map, offset)
+                if state == self.SLOT_USED:
+                    if slot_key == key:
+                        return
+                    self.collisions += 1
+                    continue
+                self.ENTRY.pack_into(self._map, offset + self.WORD.size, key, value)
+                self.WORD.pack_into(self._map, offset, self.SLOT_USED)
+                self._count += 1
+                self.WORD.pack_into(self._map, self.COUNT_OFFSET, self._count)
+                self.inserts += 1
+                return
+            self.dropped += 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def shared_stats(self):
+        """
+        Return the counters summed over all processes which closed
+        the table so far
+
+        :return: tuple (hits, misses, collisions)
+        """
+        return self.SHARED_STATS.unpack_from(self._map, self.SHARED_STATS_OFFSET)
+
+    def flush_stats(self):
+        """
+        Add the counters of this process since the previous call to
+        the shared ones in the header
+
+        :return: None
+        """
+        counters = (self.hits, self.misses, self.collisions)
+        delta = [now - before for now, before in zip(counters, self._flushed)]
+        if not any(delta):
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if not self._check_header():
+                return
+            shared = self.shared_stats()
+            self.SHARED_STATS.pack_into(self._map, self.SHARED_STATS_OFFSET,
+                                        *[a + b for a, b in zip(shared, delta)])
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._flushed = counters
+
+    def close(self):
+        """
+        Add this process's counters to the shared ones, then unmap
+        and close the table file
+
+        :return: None
+        """
+        self.flush_stats()
+        self._map.close()
+        os.close(self._fd)
+
+    def stats_str(self):
+        """
+        Return a one line summary of the table counters, meant
+        for the log file
+
+        :return: string
+        """
+        lookups = self.hits + self.misses
+        hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+        shared_hits, shared_misses, shared_collisions = self.shared_stats()
+        shared_lookups = shared_hits + shared_misses
+        shared_hit_rate = (100.0 * shared_hits / shared_lookups) if shared_lookups else 0.0
+        return ("entries=%d/%d hits=%d misses=%d inserts=%d dropped=%d collisions=%d "
+                "hit_rate=%.1f%% shared_hit_rate=%.1f%% shared_collisions=%d" % (
+                    self._count, self.slots, self.hits, self.misses, self.inserts,
+                    self.dropped, self.collisions, hit_rate, shared_hit_rate,
+                    shared_collisions))
+
+class CachingAnonymizeFunction(object):
+    """
+    Callable with the same signature as the function returned by
+    create_anonymize_fun, answering from an AnonymizationTable
+    where possible. The underlying library function is only
+    created on the first table miss, so a lookup served entirely
+    from the table never loads the library.
+    """
+
+    def __init__(self, table, create_function, function=None):
+        """
+        :param table: AnonymizationTable holding previous results
+        :param create_function: python function returning the
+                            library anonymization function
+        :param function: library anonymization function if it
+                        has already been created
+        """
+        self.table = table
+        self._create_function = create_function
+        self._function = function
+
+    def __call__(self, reversed_bytes, pass_bits):
+        if pass_bits == 0:
+            anonymized = self.table.get(reversed_bytes)
+            if anonymized is not None:
+                return anonymized
+        if self._function is None:
+            self._function = self._create_function()
+        anonymized = self._function(reversed_bytes, pass_bits) & 0xFFFFFFFF
+        if pass_bits == 0:
+            self.table.put(reversed_bytes, anonymized)
+        return anonymized
+
+    def many(self, reversed_values, pass_bits):
+        """
+        Anonymize many addresses, handing all table misses to the
+        underlying function at once if it supports that
+
+        :param reversed_values: list of int addresses in the byte
+                            order scramble_ip4 expects
+        :param pass_bits: int Number of leading bits left untouched
+
+        :return: list of int anonymized addresses in the same byte order
+        """
+        if pass_bits != 0:
+            return [self(v, pass_bits) for v in reversed_values]
+        results = [self.table.get(v) for v in reversed_values]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        if self._function is None:
+            self._function = self._create_function()
+        many = getattr(self._function, 'many', None)
+        values = [reversed_values[i] for i in missing]
+        if many is not None:
+            anonymized = many(values, pass_bits)
+        else:
+            anonymized = [self._function(v, pass_bits) for v in values]
+        for i, value in zip(missing, anonymized):
+            results[i] = value & 0xFFFFFFFF
+            self.table.put(reversed_values[i], results[i])
+        return results
+
+    def many6(self, packed, pass_bits):
+        """
+        Anonymize many IPv6 addresses, the table only holds IPv4
+        addresses so they always go to the underlying function
+
+        .. warning:: Raises UnsupportedFamilyError if the underlying
+                    function has no IPv6 support
+        """
+        if self._function is None:
+            self._function = self._create_function()
+        many6 = getattr(self._function, 'many6', None)
+        if many6 is None:
+            raise UnsupportedFamilyError("The anonymization library does not support IPv6")
+        return many6(packed, pass_bits)
+
+def initialize_anon(init_function, scramble_algo, key_file_path):
+    """
+    This function initializes the library to perform scrambling
+    
+
+    :param init_function: python function to invoke shared
+                        library initialization routine
+    :param scramble_algo: enum value The algorithm to be used
+                        for scrambling
+    :param key_file_path: string Path to the key file
+                        (will be created if not present)
+
+    :return: None
+    """
+    filename = ctypes.c_char_p(key_file_path.encode())
+    r = init_function(filename, scramble_algo, scramble_algo, None)
+    assert(r == 0), "Initialization Failed"
+
+
+def load_anonymize_fun(lib_path, key_path, scramble_algo, batch_lib_path=DEFAULT_BATCH_LIB,
+                       reverse=False):
+    """
+    Load the shared library, initialize it with the key and return
+    its anonymization function. Exits the process on failure since
+    the lookup cannot produce any output without it.
+
+    :param lib_path: string Path to libcryptopANT
+    :param key_path: string Path to the key file
+                    (will be created if not present)
+    :param scramble_algo: enum value The algorithm to be used
+                        for scrambling
+    :param batch_lib_path: string Path to the companion helper built
+                        from ip_anonymize_batch.c, used if present
+    :param reverse: bool Return the de-anonymization function
+                instead, which maps pseudonyms back to addresses
+
+    :return: NativeAnonymizeFunction
+    """
+    # Load Anonymization Library
+    try:
+        lib = ctypes.cdll.LoadLibrary(lib_path)
+    except:
+        logger.error('Could not load anonymization library at path: %s', lib_path)
+        sys.exit(1)
+
+    logger.debug("Anonymization Library Successfully loaded")
+
+    # Load functions from library
+    init_fun = create_init_fun(lib)
+    if reverse:
+        try:
+            anon_fun = create_deanonymize_fun(lib)
+        except AttributeError:
+            logger.error("No unscramble_ip4 in %s, cannot de-anonymize", lib_path)
+            sys.exit(1)
+        create6 = create_deanonymize6_fun
+    else:
+        anon_fun = create_anonymize_fun(lib)
+        create6 = create_anonymize6_fun
+    try:
+        anon6_fun = create6(lib)
+    except AttributeError:
+        logger.warning("No IPv6 support in %s, IPv6 addresses cannot be handled", lib_path)
+        anon6_fun = None
+
+    logger.debug("Function Prototypes Created")
+
+    # Initialize anonymization with key
+    try:
+        initialize_anon(init_fun, scramble_algo, key_path)
+    except:
+        logger.error("Could not initialize state with key file: %s", key_path)
+        sys.exit(1)
+
+    logger.debug("Initialized State Successfully")
+
+    # The helper is optional, without it addresses go one by one
+    batch_fun = batch6_fun = None
+    if batch_lib_path and os.path.exists(batch_lib_path):
+        try:
+            batch_lib = ctypes.cdll.LoadLibrary(batch_lib_path)
+            batch_fun = create_batch_fun(batch_lib)
+            batch6_fun = create_batch6_fun(batch_lib)
+        except (OSError, AttributeError):
+            logger.exception("Could not load batch helper at path: %s", batch_lib_path)
+        else:
+            logger.debug("Batch helper Successfully loaded")
+    return NativeAnonymizeFunction(anon_fun, batch_fun, anon6_fun, batch6_fun)
+
+def setup_anonymize_fun(lib_path, key_path, scramble_algo,
+                        cache_file=None, cache_file_slots=DEFAULT_CACHE_FILE_SLOTS,
+                        batch_lib_path=DEFAULT_BATCH_LIB, reverse=False):
+    """
+    Return the anonymization function to use for this process,
+    backed by a persistent cache file if one is given
+
+    :param lib_path: string Path to libcryptopANT
+    :param key_path: string Path to the key file
+                    (will be created if not present)
+    :param scramble_algo: enum value The algorithm to be used
+                        for scrambling
+    :param cache_file: string Path to the persistent cache file or None
+    :param cache_file_slots: int Number of slots in the cache file
+    :param batch_lib_path: string Path to the companion helper of
+                        libcryptopANT, used if present
+    :param reverse: bool Set up de-anonymization instead. The cache
+                file then holds reverse mappings and is fingerprinted
+                differently, so it is never mixed up with a forward one.
+
+    :return: tuple (anonymization function, AnonymizationTable or None)
+    """
+    load = lambda: load_anonymize_fun(lib_path, key_path, scramble_algo,
+                                      batch_lib_path, reverse)
+
+    anon_fun = None
+    table = None
+    if cache_file:
+        # The key file is created by the library, so it must be
+        # initialized before there is anything to fingerprint
+        if not os.path.exists(key_path):
+            anon_fun = load()
+        try:
+            fingerprint = key_fingerprint(key_path, scramble_algo)
+            if reverse:
+                fingerprint = hashlib.sha1(b'reverse|' + fingerprint).digest()
+            table = AnonymizationTable(cache_file, fingerprint, cache_file_slots)
+        except (IOError, OSError, ValueError):
+            logger.exception("Could not open cache file: %s", cache_file)
+
+    if table is not None:
+        # Only load the library once the table misses
+        anon_fun = CachingAnonymizeFunction(table, load, anon_fun)
+    elif anon_fun is None:
+        anon_fun = load()
+    return anon_fun, table
+
+class DedupStats(object):
+    """
+    Counts how many of the addresses in each batch were distinct,
+    i.e. how many actually had to be anonymized
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.distinct = 0
+        self.total = 0
+
+    def add(self, distinct, total):
+        """
+        Record one batch
+
+        :param distinct: int Number of distinct addresses in the batch
+        :param total: int Number of addresses in the batch
+
+        :return: None
+        """
+        self.batches += 1
+        self.distinct += distinct
+        self.total += total
+        logger.debug("Batch %d: %d distinct of %d addresses (%.1f%%)",
+                     self.batches, distinct, total,
+                     (100.0 * distinct / total) if total else 0.0)
+
+    def stats_str(self):
+        """
+        Return a one line summary over all batches, meant for the
+        log file
+
+        :return: string
+        """
+        ratio = (100.0 * self.distinct / self.total) if self.total else 0.0
+        return "batches=%d distinct=%d total=%d distinct_ratio=%.1f%%" % (
+            self.batches, self.distinct, self.total, ratio)
+
+# Wall clock with the best resolution available
+timer = getattr(time, 'perf_counter', time.time)
+
+class _StageTimer(object):
+    """
+    Context manager adding the time spent in its block to a stage
+    of RunMetrics, the elapsed seconds are kept in ``seconds``
+    """
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = timer() - self.start
+        self.metrics.add_time(self.stage, self.seconds)
+        return False
+
+class _NullStageTimer(object):
+    seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStageTimer()
+
+class TimedFunction(object):
+    """
+    Wraps an anonymization function, adding the time spent in it
+    to a stage of RunMetrics. Has ``many`` and ``many6`` methods
+    only if the wrapped function has them, so anonymize_ip_many
+    treats both the same.
+    """
+
+    def __init__(self, function, metrics, stage):
+        self.wrapped = function
+        self.metrics = metrics
+        self.stage = stage
+        if hasattr(function, 'many'):
+            self.many = self._many
+        if hasattr(function, 'many6'):
+            self.many6 = self._many6
+
+    def __call__(self, reversed_bytes, pass_bits):
+        start = timer()
+        try:
+            return self.wrapped(reversed_bytes, pass_bits)
+        finally:
+            self.metrics.add_time(self.stage, timer() - start)
+
+    def _many(self, reversed_values, pass_bits):
+        start = timer()
+        try:
+            return self.wrapped.many(reversed_values, pass_bits)
+        finally:
+            self.metrics.add_time(self.stage, timer() - start)
+
+    def _many6(self, packed, pass_bits):
+        start = timer()
+        try:
+            return self.wrapped.many6(packed, pass_bits)
+        finally:
+            self.metrics.add_time(self.stage, timer() - start)
+
+class RunMetrics(object):
+    """
+    Wall time per stage and counters of one invocation, written on
+    exit as a JSON line and/or into a Prometheus textfile collector
+    file. When not enabled every method returns at once, so the
+    row loop only pays for a few calls per batch.
+
+    Stages are read (CSV parsing), anonymize (everything done to a
+    batch between reading and writing it), scramble and daemon (the
+    part of anonymize spent in the library, or waiting for
+    the daemon), write (CSV output) and load (loading the library).
+    convert is derived as the rest of anonymize: address conversion,
+    deduplication and cache lookups. With --workers the worker
+    stages are summed over all workers. With --pipeline the sampled
+    depths of its queues are counted too.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.seconds = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.slowest = []
+        self.queue_max = {}
+        self._cache_seen = {}
+
+    def stage(self, stage):
+        """
+        Return a context manager timing its block as stage
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageTimer(self, stage)
+
+    def timed(self, function, stage):
+        """
+        Return function wrapped to time its calls as stage
+        """
+        if not self.enabled:
+            return function
+        return TimedFunction(function, self, stage)
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def add_count(self, name, count):
+        if self.enabled:
+            self.counts[name] += count
+
+    def add_chunk(self, seconds, rows):
+        """
+        Count a chunk of rows and remember it if it is one of the
+        slowest
+
+        :param seconds: float Time spent anonymizing the chunk
+        :param rows: int Number of rows in the chunk
+
+        :return: None
+        """
+        if not self.enabled:
+            return
+        self.counts['chunks'] += 1
+        item = (seconds, self.counts['chunks'], rows)
+        if len(self.slowest) < METRICS_SLOWEST_CHUNKS:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def count_cache(self, name, cache):
+        """
+        Add the hits and misses of an LRUCache or AnonymizationTable
+        since the previous call for the same name
+
+        :return: None
+        """
+        if not self.enabled:
+            return
+        seen_hits, seen_misses, seen_collisions = self._cache_seen.get(name, (0, 0, 0))
+        collisions = getattr(cache, 'collisions', 0)
+        self.counts[name + '_hits'] += cache.hits - seen_hits
+        self.counts[name + '_misses'] += cache.misses - seen_misses
+        if collisions:
+            self.counts[name + '_collisions'] += collisions - seen_collisions
+        self._cache_seen[name] = (cache.hits, cache.misses, collisions)
+
+    def count_queue(self, depth_stats):
+        """
+        Add the depths sampled by a QueueDepthStats of the pipeline
+
+        :return: None
+        """
+        if not self.enabled:
+            return
+        name = depth_stats.name
+        self.counts[name + '_queue_samples'] += depth_stats.samples
+        self.counts[name + '_queue_depth'] += depth_stats.total
+        self.queue_max[name] = max(self.queue_max.get(name, 0), depth_stats.max)
+
+    def take(self):
+        """
+        Return the stage times and counters and reset them, used to
+        ship the figures of a worker process to its parent
+
+        :return: tuple (dict of seconds, dict of counts)
+        """
+        taken = (dict(self.seconds), dict(self.counts))
+        self.seconds.clear()
+        self.counts.clear()
+        return taken
+
+    def merge(self, taken):
+        """
+        Add figures returned by take in another process
+
+        :return: None
+        """
+        seconds, counts = taken
+        for stage, value in seconds.items():
+            self.seconds[stage] += value
+        for name, value in counts.items():
+            self.counts[name] += value
+
+    def as_dict(self):
+        """
+        Return the figures of this invocation as a JSON serializable
+        dict
+
+        :return: dict
+        """
+        seconds = dict(self.seconds)
+        seconds['total'] = time.time() - self.started
+        if 'anonymize' in seconds:
+            seconds['convert'] = max(0.0, seconds['anonymize'] -
+                                     seconds.get('scramble', 0.0) -
+                                     seconds.get('daemon', 0.0))
+        hit_rate = {}
+        for name in ('cache', 'cache_file'):
+            lookups = self.counts.get(name + '_hits', 0) + self.counts.get(name + '_misses', 0)
+            if lookups:
+                hit_rate[name] = float(self.counts[name + '_hits']) / lookups
+        queue_depth = {}
+        for name, depth_max in self.queue_max.items():
+            samples = self.counts.get(name + '_queue_samples', 0)
+            queue_depth[name] = {
+                'mean': float(self.counts.get(name + '_queue_depth', 0)) / samples
+                        if samples else 0.0,
+                'max': depth_max,
+            }
+        return {
+            'timestamp': self.started,
+            'pid': os.getpid(),
+            'seconds': seconds,
+            'counts': dict(self.counts),
+            'cache_hit_rate': hit_rate,
+            'queue_depth': queue_depth,
+            'slowest_chunks': [{'chunk': chunk, 'rows': rows, 'seconds': seconds}
+                               for seconds, chunk, rows in sorted(self.slowest, reverse=True)],
+        }
+
+    def write_json(self, path):
+        """
+        Append the figures as one JSON line to path, - for stderr
+
+        :return: None
+        """
+        line = json.dumps(self.as_dict(), sort_keys=True) + '\n'
+        if path == '-':
+            sys.stderr.write(line)
+        else:
+            with open(path, 'a') as f:
+                f.write(line)
+
+    def write_prometheus(self, path):
+        """
+        Add this invocation to the counters in a Prometheus textfile
+        collector file and set the gauges describing it. The file is
+        replaced through a rename, as the collector expects, under a
+        lock so concurrent invocations do not lose each other's counts.
+
+        :param path: string Path of the .prom file
+
+        :return: None
+        """
+        run = self.as_dict()
+        samples = collections.defaultdict(float)
+        samples['ip_anon_invocations_total'] = 1
+        for stage, seconds in run['seconds'].items():
+            samples['ip_anon_stage_seconds_total{stage="%s"}' % stage] = seconds
+        for name, count in run['counts'].items():
+            samples['ip_anon_%s_total' % name] = count
+
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    for line in f:
+                        key, _, value = line.strip().rpartition(' ')
+                        if key.startswith('ip_anon_') and key.split('{')[0].endswith('_total'):
+                            samples[key] += float(value)
+            except (IOError, OSError):
+                pass
+
+            gauges = [('ip_anon_last_run_seconds', run['seconds']['total']),
+                      ('ip_anon_last_run_timestamp_seconds', run['timestamp'])]
+            for name, rate in sorted(run['cache_hit_rate'].items()):
+                gauges.append(('ip_anon_last_run_cache_hit_ratio{cache="%s"}' % name, rate))
+            for name, depth in sorted(run['queue_depth'].items()):
+                gauges.append(('ip_anon_last_run_queue_depth_mean{queue="%s"}' % name,
+                               depth['mean']))
+                gauges.append(('ip_anon_last_run_queue_depth_max{queue="%s"}' % name,
+                               depth['max']))
+
+            lines = []
+            typed = set()
+            for key, value in sorted(samples.items()) + gauges:
+                metric = key.split('{')[0]
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE %s %s' % (
+                        metric, 'counter' if metric.endswith('_total') else 'gauge'))
+                lines.append('%s %r' % (key, float(value)))
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(tmp_path, path)
+
+    def emit(self, json_path=None, prometheus_path=None):
+        """
+        Write the figures where the command line asked for them,
+        failures are logged and never fail the lookup
+
+        :return: None
+        """
+        if not self.enabled:
+            return
+        try:
+            if json_path:
+                self.write_json(json_path)
+            if prometheus_path:
+                self.write_prometheus(prometheus_path)
+        except (IOError, OSError):
+            logger.exception("Could not write metrics")
+
+def close_anonymize_fun(anon_fun, table, cache):
+    """
+    Log the counters of the cache and of what setup_anonymize_fun
+    returned, then close the cache file
+
+    :param anon_fun: anonymization function from setup_anonymize_fun
+    :param table: AnonymizationTable or None from setup_anonymize_fun
+    :param cache: LRUCache used in front of anon_fun
+
+    :return: None
+    """
+    logger.info("Address cache: %s", cache.stats_str())
+    if table is not None:
+        logger.info("Cache file: %s", table.stats_str())
+        table.close()
+
+def anonymize_distinct(addresses, anonymize_many):
+    """
+    Anonymize every distinct address of a batch exactly once
+
+    :param addresses: list of string IPv4 Addresses, may repeat
+    :param anonymize_many: python function taking a list of IPv4
+                        address strings and returning the list of
+                        anonymized strings
+
+    :return: dict mapping each address to its anonymized string
+    """
+    distinct = list(set(addresses))
+    return dict(zip(distinct, anonymize_many(distinct)))
+
+def is_ipv6_address(value):
+    """
+    Tell whether a string is an IPv6 address, without raising
+
+    :param value: string
+
+    :return: bool
+    """
+    if not IPV6_CANDIDATE.match(value):
+        return False
+    try:
+        socket.inet_pton(socket.AF_INET6, value)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+def classify_address(value):
+    """
+    Return the class of a field value and the address to anonymize
+    for it. IPv4 addresses have to be dotted decimal, inet_aton
+    would also accept octal octets and fewer than four parts.
+
+    :param value: string field value
+
+    :return: tuple (None, address) for an address, ("whitespace",
+            address) for an address with surrounding whitespace,
+            or (class name, None) with the class being one of
+            "empty", "placeholder", "hostname" or "malformed"
+    """
+    if IPV4_PATTERN.match(value):
+        return None, value
+    stripped = value.strip()
+    if IPV4_PATTERN.match(stripped) or is_ipv6_address(stripped):
+        return ('whitespace' if stripped != value else None), stripped
+    if not stripped:
+        return 'empty', None
+    if stripped in PLACEHOLDER_VALUES:
+        return 'placeholder', None
+    if HOSTNAME_PATTERN.match(stripped):
+        return 'hostname', None
+    return 'malformed', None
+
+class InvalidAddressHandler(object):
+    """
+    Keeps values which are not IP addresses away from the
+    anonymization library, where a single one would fail the whole
+    batch, and replaces them according to the on-invalid action:
+    "pass" keeps the value, "blank" empties it and "hash" replaces it
+    with a token derived from the value and the key, so equal values
+    still match across events without revealing them.
+
+    A batch is first checked in one pass with a regular expression.
+    Only batches with anything but dotted decimal IPv4 addresses are
+    then classified value by value, still without exceptions except
+    for IPv6 lookalikes which inet_pton has to confirm. Values with
+    surrounding whitespace are anonymized without it. If the library
+    turns out to have no IPv6 support, IPv6 addresses are handled as
+    invalid values of the class "unsupported" from then on. The
+    number of values of each class is counted.
+    """
+
+    def __init__(self, action, key_path, metrics=None):
+        """
+        :param action: string One of ON_INVALID_ACTIONS
+        :param key_path: string Path to the key file, hash tokens
+                        are keyed with its contents
+        :param metrics: RunMetrics counting the classes as
+                    "invalid_<class>", or None
+        """
+        assert(action in ON_INVALID_ACTIONS)
+        self.action = action
+        self.key_path = key_path
+        self.metrics = metrics
+        self.counts = collections.Counter()
+        self.ipv6_unsupported = False
+        self._hash_key = None
+
+    def classify(self, value):
+        """
+        Return the class of a field value and the address to
+        anonymize for it
+
+        .. seealso:: classify_address
+        """
+        return classify_address(value)
+
+    def token(self, value):
+        """
+        Return the replacement of an invalid value
+
+        :param value: string field value
+
+        :return: string
+        """
+        if self.action == 'pass':
+            return value
+        if self.action == 'blank':
+            return ''
+        if self._hash_key is None:
+            try:
+                with open(self.key_path, 'rb') as f:
+                    self._hash_key = hashlib.sha256(b'invalid-token|' + f.read()).digest()
+            except (IOError, OSError):
+                logger.exception("Could not read key for hash tokens, blanking instead")
+                self._hash_key = b''
+        if not self._hash_key:
+            return ''
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        digest = hmac.new(self._hash_key, value, hashlib.sha256).hexdigest()
+        return 'anon-' + digest[:16]
+
+    def wrap(self, anonymize_many):
+        """
+        Return anonymize_many with invalid values handled here
+
+        :param anonymize_many: python function taking a list of
+                            address strings and returning the list of
+                            anonymized strings
+
+        :return: python function with the same signature, which
+                accepts any strings
+        """
+        def anonymize_valid(values):
+            if all(map(IPV4_PATTERN.match, values)):
+                return anonymize_many(values)
+            while True:
+                classified = [self.classify(value) for value in values]
+                if self.ipv6_unsupported:
+                    classified = [('unsupported', None) if address and ':' in address
+                                  else (kind, address) for kind, address in classified]
+                try:
+                    anonymized = iter(anonymize_many([address for _, address in classified
+                                                      if address is not None]))
+                    break
+                except UnsupportedFamilyError:
+                    if self.ipv6_unsupported:
+                        raise
+                    logger.warning("The library cannot anonymize IPv6 addresses, "
+                                   "handling them as invalid values")
+                    self.ipv6_unsupported = True
+            results = []
+            for value, (kind, address) in zip(values, classified):
+                if kind is not None:
+                    self.count(kind)
+                results.append(self.token(value) if address is None else next(anonymized))
+            return results
+        return anonymize_valid
+
+    def select(self, values):
+        """
+        Return the addresses among values and count the other values
+        by class, for callers which skip invalid values instead of
+        replacing them
+
+        :param values: list of strings
+
+        :return: list of string addresses, without surrounding
+                whitespace
+        """
+        if all(map(IPV4_PATTERN.match, values)):
+            return values
+        addresses = []
+        for value in values:
+            kind, address = self.classify(value)
+            if kind is not None:
+                self.count(kind)
+            if address is not None:
+                addresses.append(address)
+        return addresses
+
+    def count(self, kind, number=1):
+        self.counts[kind] += number
+        if self.metrics is not None:
+            self.metrics.add_count('invalid_' + kind, number)
+
+    def take(self):
+        """
+        Return the counters and reset them, used to ship the counts
+        of a worker process to its parent
+
+        :return: dict mapping class names to counts
+        """
+        taken = dict(self.counts)
+        self.counts.clear()
+        return taken
+
+    def merge(self, taken):
+        """
+        Add counters returned by take in another process
+
+        :return: None
+        """
+        for kind, number in taken.items():
+            self.count(kind, number)
+
+    def stats_str(self):
+        """
+        Return a one line summary of the counters, meant for the
+        log file
+
+        :return: string
+        """
+        return ' '.join('%s=%d' % item for item in sorted(self.counts.items())) or 'none'
+
+def resolve_field_indices(fieldnames, field_pairs):
+    """
+    Return the column positions of the configured fields, so rows
+    can be handled as plain lists
+
+    :param fieldnames: list of string column names from the header
+    :param field_pairs: list of (input field, output field) tuples
+
+    :return: list of (input index, output index) tuples
+
+    .. warning:: Raises ValueError if a field is not in the header
+    """
+    index_pairs = []
+    for ip_field, anon_field in field_pairs:
+        for field in (ip_field, anon_field):
+            if field not in fieldnames:
+                raise ValueError("Field %s is not in the lookup table" % field)
+        index_pairs.append((fieldnames.index(ip_field), fieldnames.index(anon_field)))
+    return index_pairs
+
+def iter_records(reader, width):
+    """
+    Yield the data records of a csv.reader the way csv.DictReader
+    and csv.DictWriter would round trip them: blank lines are
+    skipped and short records are padded with empty fields
+
+    :param reader: csv.reader positioned after the header
+    :param width: int Number of columns in the header
+
+    :return: generator of lists of strings
+    """
+    for record in reader:
+        if not record:
+            continue
+        if len(record) < width:
+            record.extend([''] * (width - len(record)))
+        yield record
+
+def compile_cidr_intervals(rules):
+    """
+    Flatten nested CIDR rules of one address family into disjoint
+    intervals, so an address is classified with a single binary
+    search instead of a walk over the rules
+
+    :param rules: list of (first address as int, number of addresses,
+                value) tuples from parse_cidr. Ranges either nest or
+                are disjoint, the most specific range wins and of
+                equal ranges the last one.
+
+    :return: tuple (sorted list of int interval starts, list of the
+            value of each interval, None where no rule applies)
+    """
+    starts = []
+    values = []
+
+    def emit(start, value):
+        if starts and starts[-1] == start:
+            values[-1] = value
+            if len(values) > 1 and values[-2] == value:
+                del starts[-1], values[-1]
+        elif not values or values[-1] != value:
+            starts.append(start)
+            values.append(value)
+
+    # Enclosing ranges sort before the ranges they contain
+    open_rules = []
+    for first, size, value in sorted(rules, key=lambda rule: (rule[0], -rule[1])):
+        while open_rules and open_rules[-1][0] <= first:
+            end = open_rules.pop()[0]
+            emit(end, open_rules[-1][1] if open_rules else None)
+        emit(first, value)
+        open_rules.append((first + size, value))
+    while open_rules:
+        end = open_rules.pop()[0]
+        emit(end, open_rules[-1][1] if open_rules else None)
+    return starts, values
+
+def read_policy_file(path):
+    """
+    Read a scramble policy file. Each line holds a CIDR range or
+    address and an action: "passthrough" to keep matching addresses,
+    "anonymize" to scramble them like any other address, or
+    "anonymize N" to scramble only their first N bits. Blank lines
+    and lines starting with # are ignored.
+
+    :param path: string Path of the policy file
+
+    :return: list of (CIDR range, int bits or None) tuples
+
+    .. warning:: Raises ValueError for an invalid line
+    """
+    rules = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            words = line.split('#', 1)[0].split()
+            if not words:
+                continue
+            try:
+                family, _, _ = parse_cidr(words[0])
+                width = 128 if family == socket.AF_INET6 else 32
+                if words[1:] == ['passthrough']:
+                    bits = 0
+                elif words[1:] == ['anonymize']:
+                    bits = None
+                elif len(words) == 3 and words[1] == 'anonymize' and words[2].isdigit():
+                    bits = int(words[2])
+                    if bits > width:
+                        raise ValueError("at most %d bits can be scrambled" % width)
+                else:
+                    raise ValueError('expected "passthrough", "anonymize" or "anonymize N"')
+            except ValueError as e:
+                raise ValueError("%s line %d: %s" % (path, number, e))
+            rules.append((words[0], bits))
+    return rules
+
+def address_to_int(address):
+    """
+    Return the family and numeric value of an IPv4 or IPv6 address
+
+    :param address: string IPv4 or IPv6 Address
+
+    :return: tuple (address family, int)
+
+    .. warning:: Raises socket.error for an invalid address
+    """
+    if ':' in address:
+        return socket.AF_INET6, int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, address)), 16)
+    return socket.AF_INET, struct.unpack('!I', socket.inet_aton(address))[0]
+
+def int_to_address(family, value):
+    """
+    Return the string form of a numeric IPv4 or IPv6 address
+
+    :param family: socket.AF_INET or socket.AF_INET6
+    :param value: int address
+
+    :return: string address, IPv6 in canonical compressed form
+    """
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(family, binascii.unhexlify('%032x' % value))
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+class ScrambleDepth(object):
+    """
+    Number of leading address bits to scramble per field and per
+    CIDR range, the remaining host bits are kept as they are.
+
+    Prefix-preserving anonymization maps the first N bits of an
+    address to N bits which only depend on those first N bits. An
+    address scrambled to depth N is therefore anonymized by
+    scrambling its /N prefix with the host bits cleared and putting
+    its own host bits back. Every address of a /N shares one
+    anonymized prefix, so the caches, the cache file and the daemon
+    all work at the /N level and a /24 costs one library call
+    instead of 256. Addresses with a depth of 0, such as those of
+    passthrough ranges of a policy file, never reach the library.
+    """
+
+    def __init__(self, field_bits, cidr_bits=()):
+        """
+        :param field_bits: list of int IPv4 bits to scramble per
+                        field pair, 32 scrambles the whole address
+        :param cidr_bits: list of (CIDR range, int bits) tuples
+                        overriding the field for matching addresses
+                        of either family, the most specific range
+                        wins. None bits fall back to the field.
+        """
+        self.field_bits = list(field_bits)
+        rules = {socket.AF_INET: [], socket.AF_INET6: []}
+        for cidr, bits in cidr_bits:
+            family, first, size = parse_cidr(cidr)
+            rules[family].append((first, size, bits))
+        self._intervals = dict((family, compile_cidr_intervals(family_rules))
+                               for family, family_rules in rules.items())
+        self._range_bits = dict((family, set(bits for bits in values if bits is not None))
+                                for family, (_, values) in self._intervals.items())
+
+    @classmethod
+    def from_specs(cls, specs, field_pairs, policy_path=None):
+        """
+        Return the depths given on the command line, or None if
+        every address is scrambled completely
+
+        :param specs: list of "FIELD=BITS" or "CIDR=BITS" strings
+        :param field_pairs: list of (input field, output field) tuples
+        :param policy_path: string Path of a policy file, see
+                        read_policy_file, whose ranges the ranges of
+                        specs override
+
+        :return: ScrambleDepth or None
+
+        .. warning:: Raises ValueError for an invalid spec or policy
+                    file
+        """
+        if not specs and not policy_path:
+            return None
+        input_fields = [ip_field for ip_field, _ in field_pairs]
+        field_bits = [32] * len(field_pairs)
+        cidr_bits = []
+        if policy_path:
+            try:
+                cidr_bits.extend(read_policy_file(policy_path))
+            except (IOError, OSError) as e:
+                raise ValueError("Could not read policy file: %s" % e)
+        for spec in specs:
+            target, _, bits = spec.rpartition('=')
+            try:
+                bits = int(bits)
+            except ValueError:
+                raise ValueError("Invalid scramble bits: %s" % spec)
+            if '/' in target or ':' in target or target.replace('.', '').isdigit():
+                family, _, _ = parse_cidr(target)
+                width = 128 if family == socket.AF_INET6 else 32
+                if not 0 <= bits <= width:
+                    raise ValueError("Scramble bits must be between 0 and %d: %s" % (width, spec))
+                cidr_bits.append((target, bits))
+            elif target in input_fields:
+                if not 0 <= bits <= 32:
+                    raise ValueError("Scramble bits must be between 0 and 32: %s" % spec)
+                for i, field in enumerate(input_fields):
+                    if field == target:
+                        field_bits[i] = bits
+            else:
+                raise ValueError("Scramble bits for unknown field: %s" % spec)
+        return cls(field_bits, cidr_bits)
+
+    def bits(self, family, value, pair):
+        """
+        Return the number of bits to scramble of an address
+
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param value: int address
+        :param pair: int Index of the field pair holding the address
+
+        :return: int
+        """
+        starts, values = self._intervals[family]
+        i = bisect.bisect_right(starts, value) - 1
+        if i >= 0 and values[i] is not None:
+            return values[i]
+        if family == socket.AF_INET6:
+            return 128
+        return self.field_bits[pair]
+
+    def anonymize_distinct(self, keys, anonymize_many):
+        """
+        Anonymize (field pair, address) keys to their depth, calling
+        anonymize_many once with the distinct prefixes
+
+        :param keys: iterable of distinct (field pair index, string
+                    address) tuples
+        :param anonymize_many: python function taking a list of
+                            address strings and returning the list of
+                            anonymized strings
+
+        :return: tuple (dict mapping each key to its anonymized
+                string, number of prefixes anonymized)
+        """
+        result = {}
+        prefixes = []
+        for key in keys:
+            pair, original = key
+            _, address = classify_address(original)
+            if address is None:
+                # Left to anonymize_many, which may handle invalid values
+                prefixes.append((key, None, None, 0, original))
+                continue
+            family, value = address_to_int(address)
+            width = 128 if family == socket.AF_INET6 else 32
+            bits = self.bits(family, value, pair)
+            if bits == 0:
+                # Passed through, without surrounding whitespace
+                result[key] = address
+                continue
+            host_mask = (1 << (width - bits)) - 1
+            if bits == width:
+                prefix = address
+            else:
+                prefix = int_to_address(family, value & ~host_mask)
+            prefixes.append((key, family, value, host_mask, prefix))
+
+        anonymized = anonymize_distinct([p[4] for p in prefixes], anonymize_many)
+        for key, family, value, host_mask, prefix in prefixes:
+            if host_mask:
+                try:
+                    anonymized_family, anonymized_prefix = address_to_int(anonymized[prefix])
+                except (socket.error, ValueError):
+                    anonymized_family = None
+                if anonymized_family == family:
+                    result[key] = int_to_address(family, (anonymized_prefix & ~host_mask) |
+                                                 (value & host_mask))
+                    continue
+            # Whole addresses, and prefixes anonymize_many treated as
+            # invalid (blanked or hashed, e.g. IPv6 without
+            # scramble_ip6), have nothing to splice
+            result[key] = anonymized[prefix]
+        return result, len(anonymized)
+
+    def deanonymize_many(self, pseudonyms, reverse_many, pair=0):
+        """
+        Map pseudonyms anonymized to these depths back to addresses.
+
+        Scrambling is prefix preserving, so for every N the first N
+        bits of the completely unscrambled pseudonym are those of the
+        address. Its candidate for depth N is therefore these bits
+        followed by the host bits of the pseudonym, and it is the
+        address if its own depth is N. Pseudonyms which no depth or
+        more than one depth accounts for cannot be mapped back.
+
+        :param pseudonyms: list of string pseudonyms
+        :param reverse_many: python function taking a list of
+                            pseudonym strings and returning the list
+                            of completely unscrambled strings
+        :param pair: int Index of the field pair the pseudonyms
+                    come from
+
+        :return: tuple (list of string addresses, '' for those which
+                cannot be mapped back, number of such pseudonyms
+                which were valid addresses)
+        """
+        results = []
+        unresolved = 0
+        for pseudonym, unscrambled in zip(pseudonyms, reverse_many(pseudonyms)):
+            try:
+                family, value = address_to_int(pseudonym.strip())
+                unscrambled_family, prefixes = address_to_int(unscrambled)
+            except (socket.error, ValueError):
+                # Invalid, already handled by reverse_many
+                results.append(unscrambled)
+                continue
+            width = 128 if family == socket.AF_INET6 else 32
+            depths = set(self._range_bits[family])
+            depths.add(width if family == socket.AF_INET6 else self.field_bits[pair])
+            matches = []
+            if unscrambled_family == family:
+                for bits in depths:
+                    host_mask = (1 << (width - bits)) - 1
+                    candidate = (prefixes & ~host_mask) | (value & host_mask)
+                    if self.bits(family, candidate, pair) == bits:
+                        matches.append(candidate)
+            if len(matches) == 1:
+                results.append(int_to_address(family, matches[0]))
+            else:
+                results.append('')
+                unresolved += 1
+        return results, unresolved
+
+def anonymize_records(records, index_pairs, anonymize_many, depth=None):
+    """
+    Anonymize a batch of records in place, calling anonymize_many
+    once with the distinct addresses of all fields
+
+    :param records: list of lists of strings from iter_records
+    :param index_pairs: list of (input index, output index) tuples
+                    from resolve_field_indices
+    :param anonymize_many: python function taking a list of IPv4
+                        address strings and returning the list of
+                        anonymized strings
+    :param depth: ScrambleDepth or None to scramble whole addresses
+
+    :return: tuple (number of distinct addresses, number of addresses)
+    """
+    if depth is not None:
+        keys = [(pair, record[ip_index]) for record in records
+                for pair, (ip_index, _) in enumerate(index_pairs) if record[ip_index]]
+        anonymized, distinct = depth.anonymize_distinct(set(keys), anonymize_many)
+        for record in records:
+            for pair, (ip_index, anon_index) in enumerate(index_pairs):
+                if record[ip_index]:
+                    record[anon_index] = anonymized[(pair, record[ip_index])]
+        return distinct, len(keys)
+
+    addresses = [record[ip_index] for record in records
+                 for ip_index, _ in index_pairs if record[ip_index]]
+    anonymized = anonymize_distinct(addresses, anonymize_many)
+    for record in records:
+        for ip_index, anon_index in index_pairs:
+            if record[ip_index]:
+                record[anon_index] = anonymized[record[ip_index]]
+    return len(anonymized), len(addresses)
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon rejects a request
+    """
+
+def check_daemon_peer(sock, socket_path):
+    """
+    Make sure the process listening on socket_path runs as the
+    current user, so addresses are never handed to another user's
+    process that took over the socket path. The peer credentials
+    are used where the system has them. Otherwise the socket file
+    must belong to the current user, in a directory where no other
+    user can replace it.
+
+    :param sock: socket.socket connected to socket_path
+    :param socket_path: string Path to the daemon Unix socket
+
+    :return: None
+
+    .. warning:: Raises DaemonError if the daemon cannot be trusted
+    """
+    uid = os.getuid()
+    if SO_PEERCRED is not None:
+        creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('iII'))
+        _, peer_uid, _ = struct.unpack('iII', creds)
+        if peer_uid != uid:
+            raise DaemonError("daemon runs as uid %d, not %d" % (peer_uid, uid))
+        return
+    info = os.stat(socket_path)
+    if info.st_uid != uid:
+        raise DaemonError("socket is owned by uid %d, not %d" % (info.st_uid, uid))
+    directory = os.stat(os.path.dirname(os.path.abspath(socket_path)))
+    if directory.st_uid not in (0, uid) or (
+            directory.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and
+            not directory.st_mode & stat.S_ISVTX):
+        raise DaemonError("socket directory can be changed by other users")
+
+class DaemonClient(object):
+    """
+    Client side of the anonymization daemon protocol.
+
+    The protocol is line based. The client first checks that the
+    daemon runs as the same user, then opens with
+    "HELLO <fingerprint>" and the daemon answers "OK" only if it
+    was started with the same key and algorithm. Each batch is
+    sent as "ANON <n>" followed by n addresses, one per line, and
+    answered with "OK <n>" followed by n anonymized addresses, or
+    a single "ERR <message>" line.
+    """
+
+    def __init__(self, socket_path, fingerprint):
+        """
+        :param socket_path: string Path to the daemon Unix socket
+        :param fingerprint: bytes Digest from key_fingerprint
+
+        .. warning:: Raises socket.error if the daemon is not
+                    running and DaemonError if it runs as another
+                    user or uses another key
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.settimeout(DAEMON_CONNECT_TIMEOUT)
+            self._sock.connect(socket_path)
+            check_daemon_peer(self._sock, socket_path)
+            self._sock.settimeout(DAEMON_TIMEOUT)
+            self._rfile = self._sock.makefile('rb')
+            self._wfile = self._sock.makefile('wb')
+            self._send([b'HELLO ' + binascii.hexlify(fingerprint)])
+            reply = self._readline()
+            if reply != b'OK':
+                raise DaemonError(reply.decode('utf-8', 'replace'))
+        except:
+            self._sock.close()
+            raise
+
+    def _send(self, lines):
+        self._wfile.write(b''.join(line + b'\n' for line in lines))
+        self._wfile.flush()
+
+    def _readline(self):
+        line = self._rfile.readline()
+        if not line.endswith(b'\n'):
+            raise socket.error("Connection closed by daemon")
+        return line.rstrip(b'\n')
+
+    def anonymize(self, addresses):
+        """
+        Return the anonymized strings for a list of IPv4 address strings
+
+        :param addresses: list of string IPv4 Addresses
+
+        :return: list of string anonymized IPv4 Addresses
+        """
+        encoded = [a.encode('utf-8') for a in addresses]
+        if any(b'\n' in a or b'\r' in a for a in encoded):
+            raise ValueError("illegal IP address string")
+        self._send([('ANON %d' % len(encoded)).encode()] + encoded)
+        reply = self._readline()
+        if not reply.startswith(b'OK '):
+            raise DaemonError(reply.decode('utf-8', 'replace'))
+        count = int(reply[3:])
+        assert(count == len(encoded)), "Daemon returned a short batch"
+        return [self._readline().decode('ascii') for _ in range(count)]
+
+    def close(self):
+        """
+        Close the connection to the daemon
+
+        :return: None
+        """
+        self._sock.close()
+
+class AnonymizationRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Daemon side of the protocol described in DaemonClient
+    """
+
+    def handle(self):
+        server = self.server
+        hello = self.rfile.readline().strip()
+        if not hello:
+            # Client left before saying hello, e.g. it did not trust us
+            return
+        if hello != b'HELLO ' + binascii.hexlify(server.fingerprint):
+            self.wfile.write(b'ERR key or algorithm mismatch\n')
+            return
+        self.wfile.write(b'OK\n')
+        self.wfile.flush()
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, count = line.strip().partition(b' ')
+            if command != b'ANON' or not count.isdigit():
+                self.wfile.write(b'ERR unknown command\n')
+                return
+            addresses = [self.rfile.readline().rstrip(b'\n').decode('utf-8')
+                         for _ in range(int(count))]
+            try:
+                with server.lock:
+                    anonymized = server.anonymize_many(addresses)
+            except (socket.error, ValueError, UnicodeError) as e:
+                logger.error("Rejected batch: %s", e)
+                self.wfile.write(('ERR %s\n' % e).encode('utf-8'))
+                self.wfile.flush()
+                continue
+            self.wfile.write(('OK %d\n' % len(anonymized)).encode() +
+                             ''.join(a + '\n' for a in anonymized).encode('ascii'))
+            self.wfile.flush()
+
+class AnonymizationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Resident daemon which loads the library and key once and
+    answers anonymization batches from many lookups, all of them
+    sharing a single cache
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, fingerprint, anonymize_many):
+        """
+        :param socket_path: string Path of the Unix socket to listen on
+        :param fingerprint: bytes Digest from key_fingerprint
+        :param anonymize_many: python function taking a list of IPv4
+                            address strings and returning the list of
+                            anonymized strings
+        """
+        self.fingerprint = fingerprint
+        self.anonymize_many = anonymize_many
+        # Neither the cache nor the library are thread safe
+        self.lock = threading.Lock()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # Created without group and other access from the start
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, AnonymizationRequestHandler)
+        finally:
+            os.umask(umask)
+
+def connect_daemon(socket_path, key_path, scramble_algo):
+    """
+    Return a DaemonClient if a daemon using the same key is
+    listening on socket_path, otherwise None
+
+    :param socket_path: string Path to the daemon Unix socket
+    :param key_path: string Path to the key file
+    :param scramble_algo: enum value The algorithm to be used
+                        for scrambling
+
+    :return: DaemonClient or None
+    """
+    if not os.path.exists(socket_path) or not os.path.exists(key_path):
+        return None
+    try:
+        return DaemonClient(socket_path, key_fingerprint(key_path, scramble_algo))
+    except DaemonError as e:
+        logger.warning("Daemon at %s not trusted, running in-process: %s", socket_path, e)
+    except (socket.error, IOError, OSError) as e:
+        logger.info("Daemon at %s not usable, running in-process: %s", socket_path, e)
+    return None
+
+def reverse_str(s):
+    """
+    This is a function to reverse an input string. Solely used
+    for debugging purposes.
+
+    :param s: string
+    
+    :return: reversed(s)
+    """
+    return ''.join(reversed(s))
+
+def add_cache_arguments(parser):
+    """
+    Add the cache options shared by the lookup and the daemon
+
+    :param parser: argparse.ArgumentParser
+
+    :return: None
+    """
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='number of addresses kept in the LRU cache, '
+                             '0 disables caching (default: %(default)s)')
+    parser.add_argument('--cache-file',
+                        help='persistent cache file shared between lookups, '
+                             'invalidated automatically when the key changes')
+    parser.add_argument('--shared-cache', action='store_true',
+                        help='use a cache file in %s shared by every process '
+                             'running as the same user, instead of --cache-file'
+                             % SHARED_CACHE_DIR)
+    parser.add_argument('--cache-file-slots', type=int,
+                        default=DEFAULT_CACHE_FILE_SLOTS,
+                        help='number of slots in the cache file, a power '
+                             'of two (default: %(default)s)')
+    parser.add_argument('--batch-lib', default=DEFAULT_BATCH_LIB, metavar='PATH',
+                        help='helper built from ip_anonymize_batch.c, which '
+                             'is used to anonymize whole batches in one call '
+                             'when it exists, "" to never use it '
+                             '(default: %(default)s)')
+
+def add_logging_arguments(parser):
+    """
+    Add the options configuring the plugin log
+
+    :param parser: argparse.ArgumentParser
+
+    :return: None
+    """
+    parser.add_argument('--log-file', metavar='PATH',
+                        help='write the log to PATH (default: $%s, %s when '
+                             'only a level is given)' % (LOG_FILE_ENV, LOG_FILE))
+    parser.add_argument('--log-level', metavar='LEVEL',
+                        help='log records of LEVEL and above, e.g. DEBUG or '
+                             'INFO (default: $%s, %s)' % (
+                                 LOG_LEVEL_ENV, logging.getLevelName(LOG_LEVEL)))
+
+def check_logging_arguments(parser, args):
+    """
+    Set up the log as the options of add_logging_arguments ask
+
+    :param parser: argparse.ArgumentParser
+    :param args: argparse.Namespace
+
+    :return: None
+    """
+    if args.log_file or args.log_level:
+        try:
+            setup_logging(args.log_file, args.log_level)
+        except ValueError as e:
+            parser.error(str(e))
+
+def check_cache_arguments(parser, args):
+    """
+    Validate the options added by add_cache_arguments
+
+    :param parser: argparse.ArgumentParser
+    :param args: argparse.Namespace
+
+    :return: None
+    """
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+    slots = args.cache_file_slots
+    if slots <= 0 or slots & (slots - 1):
+        parser.error('--cache-file-slots must be a power of two')
+    if args.shared_cache:
+        if args.cache_file:
+            parser.error('--shared-cache and --cache-file are mutually exclusive')
+        args.cache_file = shared_cache_path()
+
+def shared_cache_path():
+    """
+    Return the path of the cache file shared by all processes of
+    the current user, in memory if the system allows
+
+    :return: string path
+    """
+    directory = SHARED_CACHE_DIR
+    if not os.path.isdir(directory):
+        import tempfile
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, '%s.%d.cache' % (LOG_NAME, os.getuid()))
+
+def parse_field_pairs(fields):
+    """
+    Return the (input field, output field) pairs of the lookup, whose
+    command line lists all input fields and then all output fields
+
+    :param fields: list of string field names
+
+    :return: list of (input field, output field) tuples
+
+    .. warning:: Raises ValueError for an odd number of fields or an
+                output field given twice
+    """
+    if len(fields) % 2:
+        raise ValueError("Expected as many output fields as input fields, got %d fields"
+                         % len(fields))
+    half = len(fields) // 2
+    field_pairs = list(zip(fields[:half], fields[half:]))
+    outputs = fields[half:]
+    for field in outputs:
+        if outputs.count(field) > 1:
+            raise ValueError("Output field %s is given more than once" % field)
+    return field_pairs
+
+def add_scramble_arguments(parser):
+    """
+    Add the option choosing how many address bits are scrambled
+
+    :param parser: argparse.ArgumentParser
+
+    :return: None
+    """
+    parser.add_argument('--scramble-bits', action='append', default=[],
+                        metavar='FIELD=N|CIDR=N',
+                        help='scramble only the first N bits of the addresses '
+                             'of an input field (IPv4) or of a CIDR range, '
+                             'keeping the host bits; 0 passes them through. '
+                             'May be repeated, the most specific range wins '
+                             'over the field (default: all bits)')
+    parser.add_argument('--policy', metavar='PATH',
+                        help='file of CIDR ranges to pass through ("10.0.0.0/8 '
+                             'passthrough"), anonymize, or anonymize to N bits '
+                             '("100.64.0.0/10 anonymize 16"), one per line; '
+                             '--scramble-bits ranges take precedence')
+    parser.add_argument('--on-invalid', choices=ON_INVALID_ACTIONS, default=DEFAULT_ON_INVALID,
+                        help='what to output for values which are not IP '
+                             'addresses: "pass" them through, "blank" them, or '
+                             'a keyed "hash" token (default: %(default)s)')
+
+def parse_args(argv):
+    """
+    Parse the command line of the external lookup
+
+    :param argv: list of string arguments (without the program name)
+
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py',
+        description='Splunk external lookup performing prefix preserving '
+                    'anonymization of IPv4 and IPv6 addresses')
+    parser.add_argument('key_path', help='path to key (created if missing)')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    parser.add_argument('fields', nargs='+', metavar='field',
+                        help='input fields followed by as many output fields, '
+                             'e.g. "ip_1 ip_2 ip_1_anon ip_2_anon" anonymizes '
+                             'ip_1 into ip_1_anon and ip_2 into ip_2_anon')
+    add_cache_arguments(parser)
+    add_logging_arguments(parser)
+    add_scramble_arguments(parser)
+    parser.add_argument('--daemon', action='store_true',
+                        help='send addresses to a running anonymization '
+                             'daemon of the same user when available')
+    parser.add_argument('--daemon-socket', default=DEFAULT_SOCKET_PATH,
+                        help='socket of the daemon used with --daemon '
+                             '(default: %(default)s)')
+    # The daemon used to be on by default, keep old commands working
+    parser.add_argument('--no-daemon', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of rows whose addresses are deduplicated '
+                             'and anonymized together (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each anonymizing '
+                             'batches of rows in-process (default: %(default)s)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='read, anonymize and write batches on separate '
+                             'threads so they overlap')
+    parser.add_argument('--pipeline-depth', type=int, default=DEFAULT_PIPELINE_DEPTH,
+                        help='number of batches waiting between pipeline '
+                             'stages (default: %(default)s)')
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help='append stage timings and counters as a JSON '
+                             'line to PATH on exit, - for stderr')
+    parser.add_argument('--metrics-prom', metavar='PATH',
+                        help='add stage timings and counters to a Prometheus '
+                             'textfile collector file on exit')
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    check_cache_arguments(parser, args)
+    try:
+        args.field_pairs = parse_field_pairs(args.fields)
+        args.depth = ScrambleDepth.from_specs(args.scramble_bits, args.field_pairs,
+                                              args.policy)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.batch_size <= 0:
+        parser.error('--batch-size must be positive')
+    if args.workers <= 0:
+        parser.error('--workers must be positive')
+    if args.pipeline_depth <= 0:
+        parser.error('--pipeline-depth must be positive')
+    return args
+
+def parse_serve_args(argv):
+    """
+    Parse the command line of the daemon
+
+    :param argv: list of string arguments (without "serve")
+
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py serve',
+        description='Resident daemon answering anonymization requests '
+                    'from lookups over a Unix domain socket')
+    parser.add_argument('key_path', help='path to key (created if missing)')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    add_cache_arguments(parser)
+    add_logging_arguments(parser)
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help='path of the Unix socket to listen on '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    check_cache_arguments(parser, args)
+    return args
+
+def serve(argv):
+    """
+    Run the anonymization daemon until it is terminated
+
+    :param argv: list of string arguments (without "serve")
+
+    :return: None
+    """
+    args = parse_serve_args(argv)
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+
+    anon_fun, table = setup_anonymize_fun(
+        args.lib_path, args.key_path, SCRAMBLE_ALGO,
+        args.cache_file, args.cache_file_slots, args.batch_lib)
+    cache = LRUCache(args.cache_size)
+
+    def anonymize_many(addresses):
+        return anonymize_ip_many(anon_fun, addresses, cache)
+
+    server = AnonymizationServer(
+        args.socket, key_fingerprint(args.key_path, SCRAMBLE_ALGO), anonymize_many)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("Daemon listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        close_anonymize_fun(anon_fun, table, cache)
+
+CHUNK_HEADER = re.compile(br'^chunked 1\.0,(\d+),(\d+)\n$')
+
+def read_chunk(stream):
+    """
+    Read one message of Splunk's chunked search command protocol
+
+    :param stream: binary file object to read from
+
+    :return: tuple (metadata dict, body bytes) or None at end of input
+    """
+    header = stream.readline()
+    if not header:
+        return None
+    match = CHUNK_HEADER.match(header)
+    if match is None:
+        raise ValueError("Malformed chunk header: %r" % header)
+    metadata_length, body_length = int(match.group(1)), int(match.group(2))
+    metadata = json.loads(stream.read(metadata_length).decode('utf-8'))
+    return metadata, stream.read(body_length)
+
+def write_chunk(stream, metadata, body=b''):
+    """
+    Write one message of Splunk's chunked search command protocol
+
+    :param stream: binary file object to write to
+    :param metadata: dict Message metadata
+    :param body: bytes CSV encoded records
+
+    :return: None
+    """
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    stream.write(('chunked 1.0,%d,%d\n' % (len(metadata), len(body))).encode())
+    stream.write(metadata)
+    stream.write(body)
+    stream.flush()
+
+def write_error_chunk(stream, message):
+    """
+    Tell Splunk the search command failed, the message is shown
+    in the search UI
+
+    :param stream: binary file object to write to
+    :param message: string Error message
+
+    :return: None
+    """
+    logger.error("Search command failed: %s", message)
+    write_chunk(stream, {'finished': True,
+                         'inspector': {'messages': [['ERROR', message]]}})
+
+if sys.version_info[0] >= 3:
+    def csv_body_reader(body):
+        return csv.DictReader(io.StringIO(body.decode('utf-8'), newline=''))
+
+    def csv_body_writer():
+        return io.StringIO(newline='')
+
+    def csv_body_value(buf):
+        return buf.getvalue().encode('utf-8')
+else:
+    def csv_body_reader(body):
+        return csv.DictReader(io.BytesIO(body))
+
+    def csv_body_writer():
+        return io.BytesIO()
+
+    def csv_body_value(buf):
+        return buf.getvalue()
+
+def parse_search_fields(search_args):
+    """
+    Return the (input field, output field) pairs requested in the
+    search, written as "field" to anonymize in place or
+    "field AS newfield"
+
+    :param search_args: list of string search command arguments
+
+    :return: list of (input field, output field) tuples
+    """
+    field_pairs = []
+    search_args = list(search_args)
+    while search_args:
+        ip_field = search_args.pop(0)
+        anon_field = ip_field
+        if len(search_args) >= 2 and search_args[0].lower() == 'as':
+            anon_field = search_args[1]
+            search_args = search_args[2:]
+        field_pairs.append((ip_field, anon_field))
+    if not field_pairs:
+        raise ValueError("Usage: ipanonymize <field> [AS <newfield>] ...")
+    return field_pairs
+
+def anonymize_search_rows(rows, field_pairs, anonymize_many, depth=None):
+    """
+    Anonymize a chunk of search results in place. Multivalue
+    fields hold their values separated by newlines and have a
+    "__mv_" companion field which is rewritten as well.
+
+    .. seealso:: anonymize_records
+
+    :param rows: list of dict rows from csv.DictReader
+    :param field_pairs: list of (input field, output field) tuples
+    :param anonymize_many: python function taking a list of IPv4
+                        address strings and returning the list of
+                        anonymized strings
+    :param depth: ScrambleDepth or None to scramble whole addresses
+
+    :return: tuple (number of distinct addresses, number of addresses)
+    """
+    addresses = []
+    for row in rows:
+        for pair, (ip_field, _) in enumerate(field_pairs):
+            if row.get(ip_field):
+                addresses.extend((pair, v) for v in row[ip_field].split('\n'))
+    if depth is not None:
+        anonymized, distinct = depth.anonymize_distinct(set(addresses), anonymize_many)
+        lookup = lambda pair, v: anonymized[(pair, v)]
+    else:
+        anonymized = anonymize_distinct([v for _, v in addresses], anonymize_many)
+        distinct = len(anonymized)
+        lookup = lambda pair, v: anonymized[v]
+    for row in rows:
+        for pair, (ip_field, anon_field) in enumerate(field_pairs):
+            if not row.get(ip_field):
+                continue
+            values = [lookup(pair, v) for v in row[ip_field].split('\n')]
+            row[anon_field] = '\n'.join(values)
+            if len(values) > 1:
+                row['__mv_' + anon_field] = ';'.join('$%s$' % v for v in values)
+            elif row.get('__mv_' + anon_field):
+                row['__mv_' + anon_field] = ''
+    return distinct, len(addresses)
+
+def parse_chunked_args(argv):
+    """
+    Parse the command line of the chunked search command
+
+    :param argv: list of string arguments (without "chunked")
+
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py chunked',
+        description='Splunk custom search command (chunked protocol v2) '
+                    'anonymizing the fields given in the search')
+    parser.add_argument('key_path', help='path to key (created if missing)')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    add_cache_arguments(parser)
+    add_logging_arguments(parser)
+    add_scramble_arguments(parser)
+    parser.add_argument('--distributable', action='store_true',
+                        help='let Splunk run the command on indexers, which '
+                             'then need the key and library too')
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    check_cache_arguments(parser, args)
+    return args
+
+def run_chunked(argv):
+    """
+    Serve every chunk of a search from a single process, keeping the
+    library, key and cache loaded between chunks
+
+    :param argv: list of string arguments (without "chunked")
+
+    :return: None
+    """
+    args = parse_chunked_args(argv)
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+    infile = getattr(sys.stdin, 'buffer', sys.stdin)
+    outfile = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    getinfo = read_chunk(infile)
+    if getinfo is None:
+        return
+    try:
+        field_pairs = parse_search_fields(getinfo[0]['searchinfo']['args'])
+        depth = ScrambleDepth.from_specs(args.scramble_bits, field_pairs, args.policy)
+    except (KeyError, ValueError) as e:
+        write_error_chunk(outfile, str(e) or 'Missing search arguments')
+        sys.exit(1)
+
+    try:
+        anon_fun, table = setup_anonymize_fun(
+            args.lib_path, args.key_path, SCRAMBLE_ALGO,
+            args.cache_file, args.cache_file_slots, args.batch_lib)
+    except SystemExit:
+        write_error_chunk(outfile, 'Could not initialize anonymization library')
+        raise
+    cache = LRUCache(args.cache_size)
+    dedup_stats = DedupStats()
+    invalid = InvalidAddressHandler(args.on_invalid, args.key_path)
+
+    @invalid.wrap
+    def anonymize_many(addresses):
+        return anonymize_ip_many(anon_fun, addresses, cache)
+
+    write_chunk(outfile, {'type': 'streaming' if args.distributable else 'stateful'})
+
+    while True:
+        chunk = read_chunk(infile)
+        if chunk is None:
+            break
+        metadata, body = chunk
+        finished = metadata.get('finished', False)
+
+        out_body = b''
+        if body:
+            r = csv_body_reader(body)
+            fieldnames = list(r.fieldnames or [])
+            for ip_field, anon_field in field_pairs:
+                if anon_field not in fieldnames:
+                    fieldnames.append(anon_field)
+                # Only multivalue input can produce multivalue output
+                if ('__mv_' + ip_field in fieldnames and
+                        '__mv_' + anon_field not in fieldnames):
+                    fieldnames.append('__mv_' + anon_field)
+            rows = list(r)
+            try:
+                dedup_stats.add(*anonymize_search_rows(rows, field_pairs, anonymize_many,
+                                                       depth))
+            except (socket.error, ValueError) as e:
+                write_error_chunk(outfile, 'Could not anonymize: %s' % e)
+                sys.exit(1)
+            buf = csv_body_writer()
+            w = csv.DictWriter(buf, fieldnames=fieldnames)
+            w.writeheader()
+            w.writerows(rows)
+            out_body = csv_body_value(buf)
+
+        write_chunk(outfile, {'finished': finished}, out_body)
+        if finished:
+            break
+
+    logger.info("Deduplication: %s", dedup_stats.stats_str())
+    logger.info("Invalid values: %s", invalid.stats_str())
+    close_anonymize_fun(anon_fun, table, cache)
+
+def parse_cidr(cidr):
+    """
+    Return the first address and size of an IPv4 or IPv6 CIDR range
+
+    :param cidr: string such as 10.20.0.0/16 or 2001:db8::/120, a
+                bare address is a range of one
+
+    :return: tuple (address family, first address as int,
+                    number of addresses)
+
+    .. warning:: Raises ValueError for an invalid range or one whose
+                address has host bits set
+    """
+    address, _, length = cidr.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    bits = 128 if family == socket.AF_INET6 else 32
+    try:
+        first = int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+        length = int(length) if length else bits
+    except (socket.error, ValueError):
+        raise ValueError("Invalid CIDR range: %s" % cidr)
+    if not 0 <= length <= bits:
+        raise ValueError("Invalid prefix length in CIDR range: %s" % cidr)
+    size = 1 << (bits - length)
+    if first & (size - 1):
+        raise ValueError("CIDR range has host bits set: %s" % cidr)
+    return family, first, size
+
+def iter_cidr_addresses(cidr, batch_size):
+    """
+    Yield every address of a CIDR range as strings, batch_size at a time
+
+    :param cidr: string CIDR range, see parse_cidr
+    :param batch_size: int Number of addresses per batch
+
+    :return: generator of lists of string addresses
+    """
+    family, first, size = parse_cidr(cidr)
+    for start in range(0, size, batch_size):
+        stop = min(start + batch_size, size)
+        if family == socket.AF_INET:
+            # Network order bytes read natively are the library order
+            values = array.array(UINT32_TYPECODE, struct.pack(
+                '>%dI' % (stop - start), *range(first + start, first + stop)))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            yield unpack_ipv4_many(values)
+        else:
+            yield unpack_ipv6_many(b''.join(
+                [binascii.unhexlify('%032x' % value)
+                 for value in range(first + start, first + stop)]))
+
+def iter_file_addresses(path, batch_size):
+    """
+    Yield the distinct addresses listed in a file, one per line,
+    batch_size at a time. Blank lines and lines starting with #
+    are skipped.
+
+    :param path: string Path of the file, - for stdin
+    :param batch_size: int Number of addresses per batch
+
+    :return: generator of lists of string addresses
+    """
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        seen = set()
+        batch = []
+        for line in f:
+            address = line.strip()
+            if not address or address.startswith('#') or address in seen:
+                continue
+            seen.add(address)
+            batch.append(address)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+class CsvTableWriter(object):
+    """
+    Writes the anonymized table as a Splunk CSV lookup file. The
+    file is written under a temporary name and renamed when done,
+    so Splunk never reads half a table.
+    """
+
+    def __init__(self, path, fieldnames):
+        """
+        :param path: string Path of the CSV file, - for stdout
+        :param fieldnames: list of the two string column names
+        """
+        self.path = path
+        if path == '-':
+            self._file = sys.stdout
+        else:
+            self._tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            if sys.version_info[0] >= 3:
+                self._file = open(self._tmp_path, 'w', newline='')
+            else:
+                self._file = open(self._tmp_path, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(fieldnames)
+
+    def write(self, pairs):
+        self._writer.writerows(pairs)
+
+    def close(self):
+        if self.path != '-':
+            self._file.close()
+            os.rename(self._tmp_path, self.path)
+
+    def abort(self):
+        if self.path != '-':
+            self._file.close()
+            os.unlink(self._tmp_path)
+
+class CsvTableAppender(object):
+    """
+    Appends mappings to an existing CSV lookup file, in the column
+    order of its header. A file that does not exist yet is created
+    with a header, and a last row cut short by an interrupted run
+    is dropped before appending.
+    """
+
+    def __init__(self, path, fieldnames):
+        """
+        :param path: string Path of the CSV file
+        :param fieldnames: list of the address and anonymized column
+                        names
+        """
+        self.path = path
+        binary = '' if sys.version_info[0] >= 3 else 'b'
+        kwargs = {'newline': ''} if sys.version_info[0] >= 3 else {}
+        header = read_table_header(path)
+        self._file = open(path, 'a' + binary, **kwargs)
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        if header is None:
+            header = fieldnames
+            self._file.truncate(0)
+            csv.writer(self._file).writerow(header)
+        else:
+            self._drop_partial_row()
+        self.width = len(header)
+        self.indices = table_field_indices(header, fieldnames)
+        self._writer = csv.writer(self._file)
+
+    def _drop_partial_row(self):
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            end = size
+            while end > 0:
+                f.seek(max(0, end - 4096))
+                block = f.read(end - max(0, end - 4096))
+                newline = block.rfind(b'\n')
+                if newline >= 0:
+                    end = max(0, end - 4096) + newline + 1
+                    break
+                end = max(0, end - 4096)
+        if end < size:
+            logger.warning("Dropping a partial last row of %s", self.path)
+            self._file.truncate(end)
+
+    def write(self, pairs):
+        ip_index, anon_index = self.indices
+        rows = []
+        for ip, anon in pairs:
+            row = [''] * self.width
+            row[ip_index] = ip
+            row[anon_index] = anon
+            rows.append(row)
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+def read_table_header(path):
+    """
+    Return the header of a CSV lookup file
+
+    :param path: string Path of the CSV file
+
+    :return: list of string column names, or None if the file does
+            not exist or is empty
+    """
+    try:
+        with open(path) as f:
+            return next(csv.reader(f), None)
+    except (IOError, OSError):
+        return None
+
+def table_field_indices(header, fieldnames):
+    """
+    Return the positions of the address and anonymized columns
+
+    :param header: list of string column names of the table
+    :param fieldnames: list of the address and anonymized column names
+
+    :return: tuple (address index, anonymized index)
+
+    .. warning:: Raises ValueError if a column is missing
+    """
+    for field in fieldnames:
+        if field not in header:
+            raise ValueError("Column %s is not in the table" % field)
+    return header.index(fieldnames[0]), header.index(fieldnames[1])
+
+def import_numpy():
+    """
+    Return the numpy module, or None if it is not installed. It is
+    only imported on first use, since loading it would otherwise
+    dominate the startup of every lookup.
+
+    :return: module or None
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+class SeenAddresses(object):
+    """
+    The set of addresses a lookup table already holds: IPv4
+    addresses as a sorted array of uint32 (4 bytes each, probed in
+    bulk with numpy when available), IPv6 addresses as a set of
+    packed values. It is saved next to the table and reused as long
+    as the table has not changed, so an update does not have to
+    parse the whole table again.
+    """
+
+    HEADER = struct.Struct('<4sIQQQQ')
+    MAGIC = b'IPSS'
+    VERSION = 1
+
+    def __init__(self, v4=None, v6=None):
+        """
+        :param v4: sorted array.array of uint32 in the byte order of
+                pack_ipv4_many
+        :param v6: set of 16 byte packed IPv6 addresses
+        """
+        self.v4 = v4 if v4 is not None else array.array(UINT32_TYPECODE)
+        self.v6 = v6 if v6 is not None else set()
+        self._new_v4 = set()
+
+    def __len__(self):
+        return len(self.v4) + len(self._new_v4) + len(self.v6)
+
+    @staticmethod
+    def sidecar_path(table_path):
+        return table_path + '.seen'
+
+    @classmethod
+    def load(cls, table_path, ip_field):
+        """
+        Return the addresses of a table, from its sidecar file if
+        that matches the table, otherwise by reading the table
+
+        :param table_path: string Path of the CSV lookup file
+        :param ip_field: string Name of the address column
+
+        :return: SeenAddresses
+        """
+        try:
+            stat = os.stat(table_path)
+        except OSError:
+            return cls()
+        try:
+            with open(cls.sidecar_path(table_path), 'rb') as f:
+                magic, version, size, mtime, count4, count6 = cls.HEADER.unpack(
+                    f.read(cls.HEADER.size))
+                if (magic, version, size, mtime) == (cls.MAGIC, cls.VERSION,
+                                                     stat.st_size, int(stat.st_mtime)):
+                    v4 = array.array(UINT32_TYPECODE)
+                    v4.fromfile(f, count4)
+                    if sys.byteorder == 'big':
+                        v4.byteswap()
+                    data = f.read(16 * count6)
+                    v6 = set(struct.unpack('16s' * count6, data))
+                    return cls(v4, v6)
+        except (IOError, OSError, EOFError, struct.error):
+            pass
+
+        logger.info("Reading the addresses of %s", table_path)
+        seen = cls()
+        with open(table_path) as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return seen
+            ip_index = table_field_indices(header, [ip_field, ip_field])[0]
+            while True:
+                batch = [row[ip_index] for row in itertools.islice(reader, DEFAULT_BATCH_SIZE)
+                         if len(row) > ip_index]
+                if not batch:
+                    break
+                seen.add_many(batch)
+        seen.compact()
+        return seen
+
+    def save(self, table_path):
+        """
+        Write the sidecar file of a table, valid until the table changes
+
+        :param table_path: string Path of the CSV lookup file
+
+        :return: None
+        """
+        self.compact()
+        stat = os.stat(table_path)
+        v4 = array.array(UINT32_TYPECODE, self.v4)
+        if sys.byteorder == 'big':
+            v4.byteswap()
+        path = self.sidecar_path(table_path)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, stat.st_size,
+                                     int(stat.st_mtime), len(v4), len(self.v6)))
+            v4.tofile(f)
+            f.write(b''.join(sorted(self.v6)))
+        os.rename(tmp_path, path)
+
+    def compact(self):
+        """
+        Merge the addresses added since the last call into the sorted
+        array
+
+        :return: None
+        """
+        if self._new_v4:
+            merged = set(self.v4)
+            merged.update(self._new_v4)
+            self.v4 = array.array(UINT32_TYPECODE, sorted(merged))
+            self._new_v4 = set()
+
+    def _split(self, addresses):
+        v4 = []
+        v6 = []
+        for address in addresses:
+            (v6 if ':' in address else v4).append(address)
+        return v4, v6
+
+    def _pack_v4(self, addresses):
+        """
+        Return the packed values of the valid addresses among
+        addresses, with those addresses. inet_aton alone would also
+        take shorthands such as "10.0.0" cut from a partial row.
+        """
+        valid = [address for address in addresses if IPV4_PATTERN.match(address)]
+        return valid, pack_ipv4_many(valid)
+
+    def _pack_v6(self, address):
+        try:
+            return socket.inet_pton(socket.AF_INET6, address)
+        except (socket.error, TypeError):
+            return None
+
+    def add_many(self, addresses):
+        """
+        Add addresses to the set, invalid ones are ignored
+
+        :param addresses: list of string IPv4 or IPv6 Addresses
+
+        :return: None
+        """
+        v4, v6 = self._split(addresses)
+        self._new_v4.update(self._pack_v4(v4)[1])
+        for address in v6:
+            packed = self._pack_v6(address)
+            if packed is not None:
+                self.v6.add(packed)
+
+    def missing(self, addresses):
+        """
+        Return the addresses which are not in the set yet, in order.
+        Invalid addresses are returned too, the caller decides what
+        to do with them.
+
+        :param addresses: list of string IPv4 or IPv6 Addresses
+
+        :return: list of string addresses
+        """
+        v4, _ = self._split(addresses)
+        valid, packed = self._pack_v4(v4)
+        numpy = import_numpy() if len(self.v4) else None
+        if numpy is not None:
+            table = numpy.frombuffer(self.v4, dtype=numpy.uint32)
+            values = numpy.frombuffer(packed, dtype=numpy.uint32)
+            found = numpy.searchsorted(table, values)
+            found[found == len(table)] = 0
+            present = (table[found] == values).tolist()
+        else:
+            table = self.v4
+            present = []
+            for value in packed:
+                i = bisect.bisect_left(table, value)
+                present.append(i < len(table) and table[i] == value)
+        seen_v4 = set(address for address, value, is_present in zip(valid, packed, present)
+                      if is_present or value in self._new_v4)
+
+        result = []
+        for address in addresses:
+            if ':' in address:
+                if self._pack_v6(address) in self.v6:
+                    continue
+            elif address in seen_v4:
+                continue
+            result.append(address)
+        return result
+
+def compact_table(path, fieldnames):
+    """
+    Rewrite a CSV lookup file sorted by address, IPv4 before IPv6,
+    keeping one row per address. Rows whose address cannot be parsed
+    are kept at the end. The file is replaced through a rename.
+
+    :param path: string Path of the CSV lookup file
+    :param fieldnames: list of the address and anonymized column names
+
+    :return: tuple (rows before, rows after)
+    """
+    with open(path) as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return 0, 0
+        ip_index, anon_index = table_field_indices(header, fieldnames)
+        keyed = {}
+        other = []
+        before = 0
+        for row in reader:
+            if not row:
+                continue
+            before += 1
+            address = row[ip_index] if len(row) > ip_index else ''
+            try:
+                family = socket.AF_INET6 if ':' in address else socket.AF_INET
+                key = (family, socket.inet_pton(family, address))
+            except (socket.error, TypeError, ValueError):
+                other.append(row)
+                continue
+            keyed.setdefault(key, row)
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    kwargs = {'newline': ''} if sys.version_info[0] >= 3 else {}
+    with open(tmp_path, 'w' if sys.version_info[0] >= 3 else 'wb', **kwargs) as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(keyed[key] for key in sorted(keyed))
+        w.writerows(other)
+    os.rename(tmp_path, path)
+    return before, len(keyed) + len(other)
+
+class KVStoreTableWriter(object):
+    """
+    Writes the anonymized table into a Splunk KV store collection
+    through the REST batch_save endpoint. The address is the
+    document key, so writing a table again updates it in place.
+    """
+
+    def __init__(self, url, fieldnames, token, auth_scheme='Bearer', verify=True):
+        """
+        :param url: string URL of the collection data, e.g.
+                https://localhost:8089/servicesNS/nobody/search/storage/collections/data/ip_anon
+        :param fieldnames: list of the two string field names
+        :param token: string Splunk authentication token or session key
+        :param auth_scheme: string "Bearer" for tokens, "Splunk" for
+                        session keys
+        :param verify: bool Whether to verify the TLS certificate
+        """
+        # Imported here rather than at the top, so lookups do not
+        # pay for the HTTP and TLS modules
+        try:
+            from urllib.request import Request, urlopen
+        except ImportError:
+            from urllib2 import Request, urlopen
+        self._request = Request
+        self._urlopen = urlopen
+        self.url = url.rstrip('/') + '/batch_save'
+        self.fieldnames = fieldnames
+        self.headers = {'Authorization': '%s %s' % (auth_scheme, token),
+                        'Content-Type': 'application/json'}
+        self.context = None
+        if not verify:
+            try:
+                import ssl
+            except ImportError:
+                ssl = None
+            if ssl is not None:
+                self.context = ssl._create_unverified_context()
+        self.documents = 0
+
+    def write(self, pairs):
+        ip_field, anon_field = self.fieldnames
+        for start in range(0, len(pairs), KVSTORE_BATCH_SIZE):
+            documents = [{'_key': ip, ip_field: ip, anon_field: anon}
+                         for ip, anon in pairs[start:start + KVSTORE_BATCH_SIZE]]
+            request = self._request(self.url, json.dumps(documents).encode('utf-8'),
+                                    self.headers)
+            kwargs = {'context': self.context} if self.context is not None else {}
+            self._urlopen(request, timeout=DAEMON_TIMEOUT, **kwargs).close()
+            self.documents += len(documents)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+def parse_table_args(argv):
+    """
+    Parse the command line of the lookup table generator
+
+    :param argv: list of string arguments (without "table")
+
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py table',
+        description='Anonymize CIDR ranges or lists of addresses into a '
+                    'CSV lookup file or a KV store collection, so Splunk can '
+                    'use a static lookup for them')
+    parser.add_argument('key_path', help='path to key (created if missing)')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    parser.add_argument('--cidr', action='append', default=[],
+                        help='anonymize every address of this range, may be repeated')
+    parser.add_argument('--addresses', action='append', default=[], metavar='PATH',
+                        help='anonymize the addresses listed in this file, one '
+                             'per line, - for stdin, may be repeated')
+    parser.add_argument('--output', default='-', metavar='PATH',
+                        help='CSV lookup file to write (default: stdout)')
+    parser.add_argument('--kvstore', metavar='URL',
+                        help='write into the KV store collection with this REST '
+                             'URL instead, authenticating with the token in $%s'
+                             % KVSTORE_TOKEN_ENV)
+    parser.add_argument('--kvstore-auth', choices=('Bearer', 'Splunk'), default='Bearer',
+                        help='"Bearer" for an authentication token, "Splunk" for '
+                             'a session key (default: %(default)s)')
+    parser.add_argument('--insecure', action='store_true',
+                        help='do not verify the TLS certificate of the KV store')
+    parser.add_argument('--ip-field', default='ip',
+                        help='name of the address column (default: %(default)s)')
+    parser.add_argument('--anon-field', default='ip_anon',
+                        help='name of the anonymized column (default: %(default)s)')
+    parser.add_argument('--update', action='store_true',
+                        help='append only addresses which are not in the --output '
+                             'table yet, creating it if needed')
+    parser.add_argument('--compact', action='store_true',
+                        help='afterwards rewrite the --output table sorted by '
+                             'address with one row per address')
+    parser.add_argument('--max-addresses', type=int, default=DEFAULT_TABLE_MAX_ADDRESSES,
+                        help='refuse CIDR ranges adding up to more addresses '
+                             '(default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of addresses anonymized together '
+                             '(default: %(default)s)')
+    add_cache_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    check_cache_arguments(parser, args)
+    if not args.cidr and not args.addresses and not args.compact:
+        parser.error('give at least one --cidr or --addresses')
+    if (args.update or args.compact) and (args.kvstore or args.output == '-'):
+        parser.error('--update and --compact need an --output file')
+    if args.batch_size <= 0:
+        parser.error('--batch-size must be positive')
+    try:
+        total = sum(parse_cidr(cidr)[2] for cidr in args.cidr)
+    except ValueError as e:
+        parser.error(str(e))
+    if total > args.max_addresses:
+        parser.error('the CIDR ranges hold %d addresses, more than --max-addresses %d'
+                     % (total, args.max_addresses))
+    if args.kvstore and not os.environ.get(KVSTORE_TOKEN_ENV):
+        parser.error('--kvstore needs a token in $%s' % KVSTORE_TOKEN_ENV)
+    return args
+
+def build_table(argv):
+    """
+    Write a precomputed anonymization lookup table
+
+    :param argv: list of string arguments (without "table")
+
+    :return: None
+    """
+    args = parse_table_args(argv)
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+    fieldnames = [args.ip_field, args.anon_field]
+    if not args.cidr and not args.addresses:
+        compact_table_file(args.output, fieldnames)
+        return
+
+    anon_fun, table = setup_anonymize_fun(
+        args.lib_path, args.key_path, SCRAMBLE_ALGO,
+        args.cache_file, args.cache_file_slots, args.batch_lib)
+    # Every address is new, only the cache file can help
+    cache = LRUCache(0)
+    # Address lists come from logs, lines which are not addresses
+    # are skipped. So are IPv6 addresses the library cannot handle,
+    # which the handler blanks.
+    invalid = InvalidAddressHandler('blank', args.key_path)
+    anonymize_many = invalid.wrap(lambda addresses: anonymize_ip_many(anon_fun, addresses, cache))
+
+    seen = None
+    try:
+        if args.kvstore:
+            writer = KVStoreTableWriter(args.kvstore, fieldnames, os.environ[KVSTORE_TOKEN_ENV],
+                                        args.kvstore_auth, not args.insecure)
+        elif args.update:
+            # Drops a partial last row first, so its address is
+            # not taken as present
+            writer = CsvTableAppender(args.output, fieldnames)
+            seen = SeenAddresses.load(args.output, args.ip_field)
+        else:
+            writer = CsvTableWriter(args.output, fieldnames)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    sources = [iter_cidr_addresses(cidr, args.batch_size) for cidr in args.cidr]
+    sources += [iter_file_addresses(path, args.batch_size) for path in args.addresses]
+    count = skipped = 0
+    try:
+        for addresses in itertools.chain(*sources):
+            addresses = invalid.select(addresses)
+            if seen is not None:
+                new = seen.missing(addresses)
+                skipped += len(addresses) - len(new)
+                addresses = new
+            if not addresses:
+                continue
+            pairs = [pair for pair in zip(addresses, anonymize_many(addresses)) if pair[1]]
+            if seen is not None:
+                seen.add_many([address for address, _ in pairs])
+            writer.write(pairs)
+            count += len(pairs)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    close_anonymize_fun(anon_fun, table, cache)
+    logger.info("Table: %d addresses written, %d already present, invalid values skipped: %s",
+                count, skipped, invalid.stats_str())
+    sys.stderr.write("%d addresses written, %d already present\n" % (count, skipped))
+    if invalid.counts:
+        sys.stderr.write("Skipped invalid values: %s\n" % invalid.stats_str())
+
+    if args.compact:
+        compact_table_file(args.output, fieldnames)
+    elif seen is not None:
+        seen.save(args.output)
+
+def compact_table_file(path, fieldnames):
+    """
+    Compact a table for the table subcommand and refresh its sidecar
+    file, exiting on errors
+
+    :return: None
+    """
+    try:
+        before, after = compact_table(path, fieldnames)
+        SeenAddresses.load(path, fieldnames[0]).save(path)
+    except (IOError, OSError, ValueError) as e:
+        logger.error("Could not compact %s: %s", path, e)
+        sys.stderr.write("Could not compact %s: %s\n" % (path, e))
+        sys.exit(1)
+    logger.info("Compacted %s from %d to %d rows", path, before, after)
+    sys.stderr.write("Compacted %s from %d to %d rows\n" % (path, before, after))
+
+def write_audit_record(path, record):
+    """
+    Append one JSON line to the audit log and flush it to disk. The
+    log is created readable by its owner only.
+
+    :param path: string Path of the audit log
+    :param record: dict to record
+
+    :return: None
+
+    .. warning:: Raises IOError or OSError if the record could not be
+                written
+    """
+    line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def parse_reverse_args(argv):
+    """
+    Parse the command line of the de-anonymization command
+
+    :param argv: list of string arguments (without "reverse")
+
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py reverse',
+        description='Map pseudonyms back to the original addresses for an '
+                    'investigation. Every run is recorded in an audit log '
+                    'before any address is revealed.')
+    parser.add_argument('key_path', help='path to the existing key')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    parser.add_argument('--reason', required=True,
+                        help='why the addresses are needed, e.g. a ticket '
+                             'number, recorded in the audit log')
+    parser.add_argument('--addresses', action='append', default=[], metavar='PATH',
+                        help='file listing pseudonyms, one per line, - for stdin, '
+                             'may be repeated (default: stdin)')
+    parser.add_argument('--output', default='-', metavar='PATH',
+                        help='CSV file mapping each pseudonym to its address '
+                             '(default: stdout)')
+    parser.add_argument('--ip-field', default='ip',
+                        help='name of the address column (default: %(default)s)')
+    parser.add_argument('--anon-field', default='ip_anon',
+                        help='name of the pseudonym column (default: %(default)s)')
+    parser.add_argument('--audit-log', default=DEFAULT_AUDIT_LOG, metavar='PATH',
+                        help='append-only record of every de-anonymization '
+                             '(default: %(default)s)')
+    parser.add_argument('--scramble-bits', action='append', default=[],
+                        metavar='FIELD=N|CIDR=N',
+                        help='the --scramble-bits of the lookup which produced '
+                             'the pseudonyms, FIELD being --ip-field '
+                             '(default: all bits)')
+    parser.add_argument('--policy', metavar='PATH',
+                        help='the policy file of the lookup which produced the '
+                             'pseudonyms')
+    parser.add_argument('--reverse-cache', metavar='PATH',
+                        help='persistent cache file of reverse mappings; never '
+                             'point it at the cache file of the lookup')
+    parser.add_argument('--cache-file-slots', type=int, default=DEFAULT_CACHE_FILE_SLOTS,
+                        help='number of slots in the reverse cache file, a power '
+                             'of two (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='number of pseudonyms kept in the LRU cache '
+                             '(default: %(default)s)')
+    parser.add_argument('--batch-lib', default=DEFAULT_BATCH_LIB, metavar='PATH',
+                        help='helper built from ip_anonymize_batch.c, used when '
+                             'it exists (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of pseudonyms handled together '
+                             '(default: %(default)s)')
+    add_logging_arguments(parser)
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    args.reason = args.reason.strip()
+    if not args.reason:
+        parser.error('--reason must not be empty')
+    if args.cache_size < 0:
+        parser.error('--cache-size must not be negative')
+    slots = args.cache_file_slots
+    if slots <= 0 or slots & (slots - 1):
+        parser.error('--cache-file-slots must be a power of two')
+    if args.batch_size <= 0:
+        parser.error('--batch-size must be positive')
+    if not os.path.exists(args.key_path):
+        parser.error('key file %s does not exist' % args.key_path)
+    try:
+        args.depth = ScrambleDepth.from_specs(args.scramble_bits,
+                                              [(args.ip_field, args.anon_field)], args.policy)
+    except ValueError as e:
+        parser.error(str(e))
+    if not args.addresses:
+        args.addresses = ['-']
+    return args
+
+def deanonymize(argv):
+    """
+    Map lists of pseudonyms back to their addresses, with the
+    batching, deduplication and caches of the lookup. The run is
+    recorded in the audit log first and refused if that fails.
+
+    :param argv: list of string arguments (without "reverse")
+
+    :return: None
+    """
+    args = parse_reverse_args(argv)
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+    started = time.time()
+    try:
+        import getpass
+        user = getpass.getuser()
+    except (KeyError, ImportError):
+        user = str(os.getuid())
+    audit = {
+        'user': user,
+        'uid': os.getuid(),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+        'reason': args.reason,
+        'key': binascii.hexlify(key_fingerprint(args.key_path, SCRAMBLE_ALGO)).decode('ascii'),
+        'inputs': args.addresses,
+        'output': args.output,
+        'scramble_bits': args.scramble_bits,
+        'policy': args.policy,
+    }
+
+    def record(event, **fields):
+        entry = dict(audit, event=event, time=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+        entry.update(fields)
+        try:
+            write_audit_record(args.audit_log, entry)
+        except (IOError, OSError) as e:
+            logger.error("Could not write audit log %s: %s", args.audit_log, e)
+            sys.stderr.write("Could not write audit log %s: %s\n" % (args.audit_log, e))
+            sys.exit(1)
+
+    record('start')
+    logger.warning("De-anonymization by %s: %s", user, args.reason)
+
+    reverse_fun, table = setup_anonymize_fun(
+        args.lib_path, args.key_path, SCRAMBLE_ALGO, args.reverse_cache,
+        args.cache_file_slots, args.batch_lib, reverse=True)
+    cache = LRUCache(args.cache_size)
+    invalid = InvalidAddressHandler('blank', args.key_path)
+    reverse_many = invalid.wrap(lambda pseudonyms: anonymize_ip_many(reverse_fun, pseudonyms, cache))
+
+    writer = CsvTableWriter(args.output, [args.anon_field, args.ip_field])
+    digest = hashlib.sha256()
+    count = unresolved = 0
+    try:
+        for path in args.addresses:
+            for pseudonyms in iter_file_addresses(path, args.batch_size):
+                if args.depth is None:
+                    addresses = reverse_many(pseudonyms)
+                else:
+                    addresses, missed = args.depth.deanonymize_many(pseudonyms, reverse_many)
+                    unresolved += missed
+                writer.write(list(zip(pseudonyms, addresses)))
+                for pseudonym in pseudonyms:
+                    if not isinstance(pseudonym, bytes):
+                        pseudonym = pseudonym.encode('utf-8')
+                    digest.update(pseudonym + b'\n')
+                count += len(pseudonyms)
+    except:
+        writer.abort()
+        record('failed', addresses=count)
+        raise
+    writer.close()
+    close_anonymize_fun(reverse_fun, table, cache)
+    record('done', addresses=count, invalid=dict(invalid.counts), unresolved=unresolved,
+           pseudonyms_sha256=digest.hexdigest(), seconds=round(time.time() - started, 3))
+    logger.info("Reverse: %d pseudonyms mapped, %d ambiguous or not produced with the "
+                "scramble depths", count, unresolved)
+    sys.stderr.write("%d pseudonyms mapped\n" % count)
+    if unresolved:
+        sys.stderr.write("%d pseudonyms ambiguous or not produced with the scramble depths, "
+                         "left blank\n" % unresolved)
+
+def split_compression(path):
+    """
+    Split a path into its name and compression extension
+
+    :param path: string file path
+
+    :return: tuple (path without the extension, extension or '')
+    """
+    for extension in COMPRESSION_EXTENSIONS:
+        if path.endswith(extension):
+            return path[:-len(extension)], extension
+    return path, ''
+
+def bulk_output_path(path, suffix):
+    """
+    Return the sibling file a bulk input is written to, e.g.
+    conn.log.gz becomes conn.anon.log.gz
+
+    :param path: string input path
+    :param suffix: string inserted before the file extensions
+
+    :return: string output path
+    """
+    name, compression = split_compression(path)
+    root, extension = os.path.splitext(name)
+    return root + suffix + extension + compression
+
+def is_bulk_output(path, suffix):
+    """
+    Tell whether a path was written by the bulk command, so rerunning
+    it on a directory does not anonymize its own outputs
+
+    :return: bool
+    """
+    name = split_compression(path)[0]
+    return os.path.splitext(name)[0].endswith(suffix) or name.endswith('.tmp')
+
+def find_bulk_inputs(patterns, suffix):
+    """
+    Expand files, directories (recursively) and glob patterns into
+    the list of input files, leaving out earlier outputs
+
+    :param patterns: list of string paths or glob patterns
+    :param suffix: string marking output files, see bulk_output_path
+
+    :return: list of string paths, largest first
+
+    .. warning:: Raises ValueError for a pattern matching nothing
+    """
+    import glob
+    found = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches or not os.path.exists(matches[0]):
+            raise ValueError("No such file: %s" % pattern)
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    found.extend(os.path.join(root, name) for name in sorted(files))
+            else:
+                found.append(match)
+    inputs = []
+    seen = set()
+    for path in found:
+        if is_bulk_output(path, suffix) or path in seen:
+            continue
+        seen.add(path)
+        inputs.append(path)
+    # Start the big files first so the workers finish together
+    inputs.sort(key=lambda path: -os.path.getsize(path))
+    return inputs
+
+class _ZstdPipe(object):
+    """
+    A file object reading or writing zstd through the zstd command,
+    for systems without the zstandard module
+    """
+
+    def __init__(self, path, mode):
+        import subprocess
+        if mode == 'rb':
+            self._file = None
+            self._process = subprocess.Popen(['zstd', '-q', '-d', '-c', path],
+                                             stdout=subprocess.PIPE)
+            self._stream = self._process.stdout
+        else:
+            self._file = open(path, 'wb')
+            self._process = subprocess.Popen(['zstd', '-q', '-c'], stdin=subprocess.PIPE,
+                                             stdout=self._file)
+            self._stream = self._process.stdin
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def close(self):
+        self._stream.close()
+        status = self._process.wait()
+        if self._file is not None:
+            self._file.close()
+        if status:
+            raise IOError("zstd exited with status %d" % status)
+
+def open_bulk_file(path, mode, extension=None):
+    """
+    Open a plain, gzip or zstd compressed file by its extension, as
+    text in the way the csv module expects
+
+    :param path: string file path
+    :param mode: 'r' or 'w'
+    :param extension: string compression extension, taken from path
+                    if None
+
+    :return: file object
+
+    .. warning:: Raises IOError if zstd is neither installed as the
+                zstandard module nor as a command
+    """
+    if extension is None:
+        extension = split_compression(path)[1]
+    if extension == '.gz':
+        import gzip
+        raw = gzip.open(path, mode + 'b', compresslevel=6) if mode == 'w' \
+            else gzip.open(path, 'rb')
+    elif extension == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            zstandard = None
+        if zstandard is not None:
+            if mode == 'w':
+                raw = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+            else:
+                raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        else:
+            try:
+                raw = _ZstdPipe(path, mode + 'b')
+            except OSError:
+                raise IOError("Reading %s needs the zstandard module or the zstd command"
+                              % path)
+    else:
+        raw = open(path, mode + 'b')
+    if sys.version_info[0] < 3:
+        return raw
+    if extension and mode == 'r':
+        raw = io.BufferedReader(raw) if not hasattr(raw, 'peek') else raw
+    # surrogateescape round trips bytes which are not UTF-8
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogateescape', newline='')
+
+def _anonymize_zeek_values(rows, indices, anonymize_many, set_separator, keep):
+    """
+    Anonymize the address columns of split Zeek TSV or JSON rows in
+    place, set fields holding several addresses included
+
+    :return: tuple (number of distinct addresses, number of addresses)
+    """
+    addresses = []
+    for row in rows:
+        for i in indices:
+            value = row[i]
+            if value in keep:
+                continue
+            if set_separator in value:
+                addresses.extend(v for v in value.split(set_separator) if v not in keep)
+            else:
+                addresses.append(value)
+    anonymized = anonymize_distinct(addresses, anonymize_many)
+    for row in rows:
+        for i in indices:
+            value = row[i]
+            if value in keep:
+                continue
+            if set_separator in value:
+                row[i] = set_separator.join(v if v in keep else anonymized[v]
+                                            for v in value.split(set_separator))
+            else:
+                row[i] = anonymized[value]
+    return len(anonymized), len(addresses)
+
+def anonymize_bulk_stream(infile, outfile, fields, anonymize_many, batch_size):
+    """
+    Anonymize one exported log, detecting its format from the first
+    line: Zeek TSV (a #separator header), Zeek JSON (one object per
+    line) or CSV with a header. The listed fields are replaced in
+    place and everything else is copied as it is.
+
+    :param infile: text file object to read
+    :param outfile: text file object to write
+    :param fields: list of string names of the address fields, those
+                missing from the file are ignored
+    :param anonymize_many: python function taking a list of address
+                        strings and returning the list of anonymized
+                        strings
+    :param batch_size: int Number of lines handled together
+
+    :return: tuple (rows, distinct addresses, addresses), or None if
+            the file has none of the fields
+    """
+    first = infile.readline()
+    if first.startswith('#separator'):
+        return _anonymize_zeek_tsv(first, infile, outfile, fields, anonymize_many, batch_size)
+    if first.lstrip().startswith('{'):
+        return _anonymize_zeek_json(first, infile, outfile, fields, anonymize_many, batch_size)
+
+    reader = csv.reader(itertools.chain([first], infile))
+    fieldnames = next(reader, None) or []
+    indices = [i for i, name in enumerate(fieldnames) if name in fields]
+    if not indices:
+        return None
+    w = csv.writer(outfile)
+    w.writerow(fieldnames)
+    index_pairs = [(i, i) for i in indices]
+    records = iter_records(reader, len(fieldnames))
+    rows = distinct = total = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        counts = anonymize_records(batch, index_pairs, anonymize_many)
+        w.writerows(batch)
+        rows += len(batch)
+        distinct += counts[0]
+        total += counts[1]
+    return rows, distinct, total
+
+def _anonymize_zeek_tsv(first, infile, outfile, fields, anonymize_many, batch_size):
+    separator = first.split(' ', 1)[1].strip()
+    if separator.startswith('\\x'):
+        separator = chr(int(separator[2:], 16))
+    set_separator, keep = ',', set(['-', '(empty)'])
+    indices = None
+    outfile.write(first)
+    rows = distinct = total = 0
+    lines = iter(infile)
+    while True:
+        batch = []
+        for line in lines:
+            if line.startswith('#'):
+                if batch:
+                    # Write the rows read so far first, they may
+                    # belong to a #fields header this line replaces,
+                    # and a #close has to stay after them
+                    lines = itertools.chain([line], lines)
+                    break
+                outfile.write(line)
+                name, _, value = line[1:].rstrip('\r\n').partition(separator)
+                if name == 'set_separator':
+                    set_separator = value
+                elif name in ('unset_field', 'empty_field'):
+                    keep.add(value)
+                elif name == 'fields':
+                    columns = value.split(separator)
+                    indices = [i for i, column in enumerate(columns) if column in fields]
+                    if not indices:
+                        return None
+                continue
+            batch.append(line.rstrip('\r\n').split(separator))
+            if len(batch) >= batch_size:
+                break
+        if not batch:
+            break
+        if indices is None:
+            raise ValueError("Zeek log without #fields header")
+        counts = _anonymize_zeek_values(batch, indices, anonymize_many, set_separator, keep)
+        outfile.writelines(separator.join(row) + '\n' for row in batch)
+        rows += len(batch)
+        distinct += counts[0]
+        total += counts[1]
+    if indices is None:
+        return None
+    return rows, distinct, total
+
+def _json_address_value(value):
+    if isinstance(value, list):
+        if all(isinstance(v, JSON_STRING_TYPES) and v for v in value):
+            return '\n'.join(value)
+        return ''
+    return value if isinstance(value, JSON_STRING_TYPES) else ''
+
+def _json_line(o):
+    # Non-ASCII text is kept as is rather than escaped
+    line = json.dumps(o, separators=(',', ':'), ensure_ascii=False)
+    if not isinstance(line, str):
+        # Python 2 returns unicode as soon as a value is not ASCII
+        line = line.encode('utf-8')
+    return line + '\n'
+
+def _anonymize_zeek_json(first, infile, outfile, fields, anonymize_many, batch_size):
+    rows = distinct = total = 0
+    found = False
+    lines = itertools.chain([first], infile)
+    while True:
+        batch = [line for line in itertools.islice(lines, batch_size) if line.strip()]
+        if not batch:
+            break
+        objects = [json.loads(line, object_pairs_hook=collections.OrderedDict) for line in batch]
+        present = [field for field in fields if any(field in o for o in objects)]
+        found = found or bool(present)
+        # Sets are lists, joined for anonymization and split again,
+        # missing fields and values which are not strings are kept
+        values = [[_json_address_value(o.get(field)) for field in present] for o in objects]
+        counts = _anonymize_zeek_values(values, range(len(present)), anonymize_many, '\n',
+                                        set(['']))
+        for o, row in zip(objects, values):
+            for field, value in zip(present, row):
+                if value:
+                    o[field] = value.split('\n') if isinstance(o[field], list) else value
+        outfile.writelines(_json_line(o) for o in objects)
+        rows += len(batch)
+        distinct += counts[0]
+        total += counts[1]
+    if not found:
+        return None
+    return rows, distinct, total
+
+_bulk_state = {}
+
+def init_bulk_worker(lib_path, key_path, scramble_algo, cache_file, cache_file_slots,
+                     batch_lib_path, cache_size, on_invalid):
+    """
+    Pool initializer of the bulk command, loads the library and key
+    once per worker. A failure is remembered and reported by the
+    first file.
+
+    :return: None
+    """
+    reset_logging()
+    try:
+        anon_fun, table = setup_anonymize_fun(lib_path, key_path, scramble_algo,
+                                              cache_file, cache_file_slots,
+                                              batch_lib_path)
+    except SystemExit:
+        _bulk_state['error'] = "Worker %d could not initialize anonymization" % os.getpid()
+        return
+    cache = LRUCache(cache_size)
+    invalid = InvalidAddressHandler(on_invalid, key_path)
+    _bulk_state['anonymize_many'] = invalid.wrap(lambda addresses: anonymize_ip_many(
+        anon_fun, addresses, cache))
+    _bulk_state['invalid'] = invalid
+
+def anonymize_bulk_file(task):
+    """
+    Worker side of run_bulk, anonymize one file into its sibling
+    output through a temporary file
+
+    :param task: tuple (input path, output path, list of fields,
+                batch size)
+
+    :return: tuple (input path, bytes read, rows or None if the file
+            has no address fields, distinct addresses, addresses,
+            seconds, invalid counts, error message or None)
+    """
+    path, output_path, fields, batch_size = task
+    started = time.time()
+    size = os.path.getsize(path)
+    if 'error' in _bulk_state:
+        return path, size, 0, 0, 0, 0.0, {}, _bulk_state['error']
+    tmp_path = '%s.%d.tmp' % (output_path, os.getpid())
+    try:
+        infile = open_bulk_file(path, 'r')
+        try:
+            outfile = open_bulk_file(tmp_path, 'w', split_compression(output_path)[1])
+            try:
+                result = anonymize_bulk_stream(infile, outfile, fields,
+                                               _bulk_state['anonymize_many'], batch_size)
+            finally:
+                outfile.close()
+        finally:
+            infile.close()
+    except (IOError, OSError, ValueError, socket.error, csv.Error, EOFError) as e:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return path, size, 0, 0, 0, time.time() - started, {}, str(e)
+    if result is None:
+        os.unlink(tmp_path)
+        return path, size, None, 0, 0, time.time() - started, {}, None
+    os.rename(tmp_path, output_path)
+    rows, distinct, total = result
+    return (path, size, rows, distinct, total, time.time() - started,
+            _bulk_state['invalid'].take(), None)
+
+def parse_bulk_args(argv):
+    """
+    Parse the command line of the bulk file anonymizer
+
+    :param argv: list of string arguments (without "bulk")
+
+    :return: argparse.Namespace
+    """
+    import multiprocessing
+    parser = argparse.ArgumentParser(
+        prog='ip_anonymize.py bulk',
+        description='Anonymize exported Zeek TSV, Zeek JSON or CSV logs, '
+                    'plain or compressed with gzip or zstd, into sibling '
+                    'files next to them')
+    parser.add_argument('key_path', help='path to key (created if missing)')
+    parser.add_argument('lib_path', help='path to libcryptopANT shared library')
+    parser.add_argument('inputs', nargs='+', metavar='input',
+                        help='files, directories (searched recursively) or '
+                             'glob patterns')
+    parser.add_argument('--fields', default=','.join(DEFAULT_BULK_FIELDS),
+                        help='comma separated address fields to anonymize, '
+                             'those missing from a file are ignored '
+                             '(default: %(default)s)')
+    parser.add_argument('--suffix', default=DEFAULT_BULK_SUFFIX,
+                        help='inserted before the extensions of the output '
+                             'name, conn.log.gz becomes conn%(default)s.log.gz '
+                             '(default: %(default)s)')
+    parser.add_argument('--force', action='store_true',
+                        help='overwrite existing outputs instead of skipping '
+                             'their inputs')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of files anonymized in parallel '
+                             '(default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of lines whose addresses are anonymized '
+                             'together (default: %(default)s)')
+    parser.add_argument('--on-invalid', choices=ON_INVALID_ACTIONS, default=DEFAULT_ON_INVALID,
+                        help='what to write for values which are not IP '
+                             'addresses; Zeek unset and empty markers are '
+                             'always kept (default: %(default)s)')
+    add_cache_arguments(parser)
+    add_logging_arguments(parser)
+    args = parser.parse_args(argv)
+    check_logging_arguments(parser, args)
+    check_cache_arguments(parser, args)
+    args.fields = [field for field in args.fields.split(',') if field]
+    if not args.fields:
+        parser.error('--fields must name at least one field')
+    if args.workers <= 0:
+        parser.error('--workers must be positive')
+    if args.batch_size <= 0:
+        parser.error('--batch-size must be positive')
+    if args.suffix in ('', '.tmp'):
+        parser.error('--suffix must mark the outputs')
+    return args
+
+def run_bulk(argv):
+    """
+    Anonymize many exported log files with a pool of worker
+    processes, one file per worker at a time, and report the
+    aggregate throughput. Use --shared-cache or --cache-file so the
+    workers share their results.
+
+    :param argv: list of string arguments (without "bulk")
+
+    :return: None
+    """
+    args = parse_bulk_args(argv)
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+    try:
+        inputs = find_bulk_inputs(args.inputs, args.suffix)
+    except (ValueError, OSError) as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    tasks = []
+    for path in inputs:
+        output_path = bulk_output_path(path, args.suffix)
+        if os.path.exists(output_path) and not args.force:
+            sys.stderr.write("%s: skipped, %s exists\n" % (path, output_path))
+            continue
+        tasks.append((path, output_path, args.fields, args.batch_size))
+    if not tasks:
+        sys.stderr.write("Nothing to do\n")
+        return
+
+    # Make sure the key exists before the workers race to create it
+    if not os.path.exists(args.key_path):
+        anon_fun, table = setup_anonymize_fun(
+            args.lib_path, args.key_path, SCRAMBLE_ALGO, None,
+            args.cache_file_slots, args.batch_lib)
+
+    import multiprocessing
+    started = time.time()
+    pool = multiprocessing.Pool(
+        min(args.workers, len(tasks)), init_bulk_worker,
+        (args.lib_path, args.key_path, SCRAMBLE_ALGO, args.cache_file,
+         args.cache_file_slots, args.batch_lib, args.cache_size,
+         args.on_invalid))
+    invalid = InvalidAddressHandler(args.on_invalid, args.key_path)
+    files = failed = size = rows = distinct = total = 0
+    try:
+        for result in pool.imap_unordered(anonymize_bulk_file, tasks):
+            path, file_size, file_rows, file_distinct, file_total, seconds, \
+                invalid_taken, error = result
+            if error is not None:
+                failed += 1
+                logger.error("%s: %s", path, error)
+                sys.stderr.write("%s: failed, %s\n" % (path, error))
+                continue
+            if file_rows is None:
+                logger.warning("%s: skipped, none of the fields %s", path, args.fields)
+                sys.stderr.write("%s: skipped, no address fields\n" % path)
+                continue
+            files += 1
+            size += file_size
+            rows += file_rows
+            distinct += file_distinct
+            total += file_total
+            invalid.merge(invalid_taken)
+            sys.stderr.write("%s: %d rows, %d addresses in %.1fs\n"
+                             % (path, file_rows, file_total, seconds))
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    elapsed = max(time.time() - started, 1e-9)
+    summary = ("%d files, %.1f MB, %d rows, %d addresses (%d distinct per batch) in %.1fs: "
+               "%.1f MB/s, %.0f rows/s, %.0f addresses/s" % (
+                   files, size / 1e6, rows, total, distinct, elapsed, size / 1e6 / elapsed,
+                   rows / elapsed, total / elapsed))
+    logger.info("Bulk: %s, invalid values: %s", summary, invalid.stats_str())
+    sys.stderr.write("%s\n" % summary)
+    if invalid.counts:
+        sys.stderr.write("Invalid values: %s\n" % invalid.stats_str())
+    if failed:
+        sys.stderr.write("%d files failed\n" % failed)
+        sys.exit(1)
+
+class QueueDepthStats(object):
+    """
+    Samples the depth of a pipeline queue every time a batch is
+    taken out of it. A queue that is usually full points at a slow
+    consumer, one that is usually empty at a slow producer.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: string Name of the queue in the log
+        """
+        self.name = name
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self, depth):
+        """
+        Record one observed queue depth
+
+        :param depth: int Number of batches in the queue
+
+        :return: None
+        """
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    def stats_str(self):
+        """
+        Return a one line summary of the depths, meant for the log file
+
+        :return: string
+        """
+        mean = (float(self.total) / self.samples) if self.samples else 0.0
+        return "%s_queue mean=%.2f max=%d" % (self.name, mean, self.max)
+
+# Marks the end of the batches passed between pipeline stages
+_PIPELINE_END = object()
+
+def _pipeline_stage(source, function, sink):
+    # Runs on its own thread, passes failures downstream instead of
+    # leaving the next stage waiting forever
+    try:
+        for item in source:
+            sink.put((True, function(item)))
+    except Exception as e:
+        logger.exception("Pipeline stage failed")
+        sink.put((False, e))
+        return
+    sink.put((True, _PIPELINE_END))
+
+def _drain_queue(q, depth_stats):
+    while True:
+        depth_stats.sample(q.qsize())
+        ok, item = q.get()
+        if not ok:
+            raise item
+        if item is _PIPELINE_END:
+            return
+        yield item
+
+def run_pipeline(batches, process, write, depth=DEFAULT_PIPELINE_DEPTH):
+    """
+    Read, process and write batches as three overlapping stages.
+    Reading and processing run on their own threads, connected to
+    each other and to the writing stage by bounded queues, so pipe
+    I/O overlaps with the library calls, which release the GIL.
+
+    :param batches: iterable of batches, consumed on the reading thread
+    :param process: python function applied to each batch on the
+                processing thread
+    :param write: python function called with each processed batch,
+                in order, on the calling thread
+    :param depth: int Maximum number of batches waiting in each queue
+
+    :return: list of QueueDepthStats for both queues
+    """
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+    read_stats = QueueDepthStats('read')
+    write_stats = QueueDepthStats('write')
+
+    threads = [
+        threading.Thread(target=_pipeline_stage,
+                         args=(batches, lambda batch: batch, read_queue)),
+        threading.Thread(target=_pipeline_stage,
+                         args=(_drain_queue(read_queue, read_stats), process, write_queue)),
+    ]
+    for thread in threads:
+        # Do not keep the process alive if writing fails
+        thread.daemon = True
+        thread.start()
+    for item in _drain_queue(write_queue, write_stats):
+        write(item)
+    for thread in threads:
+        thread.join()
+    return [read_stats, write_stats]
+
+# State of a worker process in the pool used by run_worker_pool
+_worker_state = {}
+
+def init_worker(lib_path, key_path, scramble_algo, cache_file, cache_file_slots,
+                batch_lib_path, cache_size, index_pairs, depth=None,
+                on_invalid=DEFAULT_ON_INVALID, with_metrics=False):
+    """
+    Pool initializer, loads the library and key once per worker.
+    A failure is remembered and reported by the first chunk, since
+    exiting here would only make the pool start another worker.
+
+    :return: None
+    """
+    reset_logging()
+    try:
+        anon_fun, _ = setup_anonymize_fun(lib_path, key_path, scramble_algo,
+                                          cache_file, cache_file_slots, batch_lib_path)
+    except SystemExit:
+        _worker_state['error'] = "Worker %d could not initialize anonymization" % os.getpid()
+        return
+    cache = LRUCache(cache_size)
+    metrics = RunMetrics(with_metrics)
+    timed_fun = metrics.timed(anon_fun, 'scramble')
+    invalid = InvalidAddressHandler(on_invalid, key_path)
+    _worker_state['anonymize_many'] = invalid.wrap(lambda addresses: anonymize_ip_many(
+        timed_fun, addresses, cache))
+    _worker_state['invalid'] = invalid
+    _worker_state['index_pairs'] = index_pairs
+    _worker_state['depth'] = depth
+    _worker_state['cache'] = cache
+    _worker_state['metrics'] = metrics
+
+def anonymize_csv_chunk(records):
+    """
+    Worker side of run_worker_pool, anonymize a chunk of parsed CSV
+    records and serialize them again
+
+    :param records: list of lists of strings from iter_records
+
+    :return: tuple (CSV text, number of distinct addresses,
+                    number of addresses, RunMetrics.take of the chunk,
+                    InvalidAddressHandler.take of the chunk)
+    """
+    if 'error' in _worker_state:
+        raise RuntimeError(_worker_state['error'])
+    metrics = _worker_state['metrics']
+    with metrics.stage('anonymize'):
+        distinct, total = anonymize_records(records, _worker_state['index_pairs'],
+                                            _worker_state['anonymize_many'],
+                                            _worker_state['depth'])
+    with metrics.stage('write'):
+        buf = csv_body_writer()
+        csv.writer(buf).writerows(records)
+    metrics.count_cache('cache', _worker_state['cache'])
+    return buf.getvalue(), distinct, total, metrics.take(), _worker_state['invalid'].take()
+
+def run_worker_pool(args, index_pairs, scramble_algo, fieldnames, records, outfile,
+                    metrics, invalid):
+    """
+    Anonymize the lookup table with a pool of worker processes.
+    Chunks of records are handed out in order and their results
+    written in the same order, so the output is identical to
+    single process mode.
+
+    :param args: argparse.Namespace from parse_args
+    :param index_pairs: list of (input index, output index) tuples
+                    from resolve_field_indices
+    :param scramble_algo: enum value The algorithm to be used
+                        for scrambling
+    :param fieldnames: list of string column names from the header
+    :param records: iterable of records from iter_records
+    :param outfile: file object to write the lookup table to
+    :param metrics: RunMetrics, the figures of the workers are
+                added to it
+    :param invalid: InvalidAddressHandler, the counts of the workers
+                are added to it
+
+    :return: DedupStats
+    """
+    import multiprocessing
+    dedup_stats = DedupStats()
+    pool = multiprocessing.Pool(
+        args.workers, init_worker,
+        (args.lib_path, args.key_path, scramble_algo, args.cache_file,
+         args.cache_file_slots, args.batch_lib, args.cache_size, index_pairs,
+         args.depth, args.on_invalid, metrics.enabled))
+    header = [True]
+
+    def write_result(item):
+        result, rows = item
+        text, distinct, total, taken, invalid_taken = result.get()
+        with metrics.stage('write'):
+            if header:
+                # Held back until a worker succeeded, so a broken
+                # library produces no output at all
+                csv.writer(outfile).writerow(fieldnames)
+                del header[:]
+            outfile.write(text)
+        dedup_stats.add(distinct, total)
+        metrics.merge(taken)
+        invalid.merge(invalid_taken)
+        metrics.add_chunk(taken[0].get('anonymize', 0.0), rows)
+        metrics.add_count('rows', rows)
+        metrics.add_count('addresses', total)
+        metrics.add_count('distinct_addresses', distinct)
+
+    # Keep a bounded number of chunks in flight
+    pending = collections.deque()
+    try:
+        while True:
+            with metrics.stage('read'):
+                chunk = list(itertools.islice(records, args.batch_size))
+            if not chunk:
+                break
+            pending.append((pool.apply_async(anonymize_csv_chunk, (chunk,)), len(chunk)))
+            if len(pending) >= 2 * args.workers:
+                write_result(pending.popleft())
+        while pending:
+            write_result(pending.popleft())
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    if header:
+        csv.writer(outfile).writerow(fieldnames)
+    return dedup_stats
+
+def main():
+    try:
+        setup_logging()
+    except ValueError as e:
+        sys.stderr.write("Logging disabled: %s\n" % e)
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['chunked']:
+        run_chunked(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['table']:
+        build_table(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['reverse']:
+        deanonymize(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['bulk']:
+        run_bulk(sys.argv[2:])
+        return
+
+    try:
+        args = parse_args(sys.argv[1:])
+    except SystemExit as e:
+        if e.code:
+            logger.error("Incorrect invokation used : %s", ' '.join(map(str, sys.argv)))
+        raise
+
+    # Parse Command Line Args
+    KEYPATH = args.key_path
+    LIBPATH = args.lib_path
+    
+    SCRAMBLE_ALGO = ScrambleAlgo.SCRAMBLE_BLOWFISH
+    field_pairs = args.field_pairs
+
+    metrics = RunMetrics(bool(args.metrics_json or args.metrics_prom))
+    invalid = InvalidAddressHandler(args.on_invalid, KEYPATH, metrics)
+
+    # Get splunk pipes
+    infile = sys.stdin
+    outfile = sys.stdout
+
+    # Parse input table header, rows are handled as plain lists
+    reader = csv.reader(infile)
+    fieldnames = next(reader, None)
+    if fieldnames is None:
+        return
+    try:
+        index_pairs = resolve_field_indices(fieldnames, field_pairs)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(1)
+    records = iter_records(reader, len(fieldnames))
+
+    if args.workers > 1:
+        try:
+            dedup_stats = run_worker_pool(args, index_pairs, SCRAMBLE_ALGO,
+                                          fieldnames, records, outfile, metrics,
+                                          invalid)
+        except RuntimeError as e:
+            logger.error("%s", e)
+            sys.exit(1)
+        logger.info("Deduplication: %s", dedup_stats.stats_str())
+        logger.info("Invalid values: %s", invalid.stats_str())
+        metrics.emit(args.metrics_json, args.metrics_prom)
+        return
+
+    # Prefer a running daemon, it has the library loaded and a warm cache
+    client = None
+    if args.daemon:
+        client = connect_daemon(args.daemon_socket, KEYPATH, SCRAMBLE_ALGO)
+
+    # Addresses repeat a lot within a lookup, remember recent results
+    cache = LRUCache(args.cache_size)
+    in_process = {}
+
+    def anonymize_locally(addresses):
+        if not in_process:
+            with metrics.stage('load'):
+                in_process['fun'], in_process['table'] = setup_anonymize_fun(
+                    LIBPATH, KEYPATH, SCRAMBLE_ALGO,
+                    args.cache_file, args.cache_file_slots, args.batch_lib)
+            in_process['timed_fun'] = metrics.timed(in_process['fun'], 'scramble')
+        return anonymize_ip_many(in_process['timed_fun'], addresses, cache)
+
+    @invalid.wrap
+    def anonymize_many(addresses):
+        if client is not None and not in_process:
+            try:
+                with metrics.stage('daemon'):
+                    return client.anonymize(addresses)
+            except (socket.error, IOError, OSError, DaemonError):
+                logger.exception("Daemon failed, continuing in-process")
+        return anonymize_locally(addresses)
+
+    if client is None:
+        # Fail before writing any output if the library is unusable
+        anonymize_locally([])
+
+    # Create output table
+    w = csv.writer(outfile)
+    w.writerow(fieldnames)
+
+    dedup_stats = DedupStats()
+
+    def read_batches():
+        # Anonymize the input table a batch of rows at a time so
+        # every distinct address is only anonymized once per batch
+        while True:
+            with metrics.stage('read'):
+                rows = list(itertools.islice(records, args.batch_size))
+            if not rows:
+                return
+            yield rows
+
+    def process(rows):
+        with metrics.stage('anonymize') as stage:
+            counts = anonymize_records(rows, index_pairs, anonymize_many, args.depth)
+        metrics.add_chunk(stage.seconds, len(rows))
+        return rows, counts
+
+    def write(processed):
+        rows, (distinct, total) = processed
+        dedup_stats.add(distinct, total)
+        metrics.add_count('rows', len(rows))
+        metrics.add_count('addresses', total)
+        metrics.add_count('distinct_addresses', distinct)
+        with metrics.stage('write'):
+            w.writerows(rows)
+
+    if args.pipeline:
+        for depth_stats in run_pipeline(read_batches(), process, write,
+                                        args.pipeline_depth):
+            logger.info("Pipeline: %s", depth_stats.stats_str())
+            metrics.count_queue(depth_stats)
+    else:
+        for rows in read_batches():
+            write(process(rows))
+
+    logger.info("Deduplication: %s", dedup_stats.stats_str())
+    logger.info("Invalid values: %s", invalid.stats_str())
+
+    if client is not None:
+        client.close()
+    if in_process:
+        metrics.count_cache('cache', cache)
+        if in_process['table'] is not None:
+            metrics.count_cache('cache_file', in_process['table'])
+        close_anonymize_fun(in_process['fun'], in_process['table'], cache)
+    metrics.emit(args.metrics_json, args.metrics_prom)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""
+This module compares the scalar address conversions
+(ip2long/swap32 and swap32/long2ip per address) with the
+batch conversions pack_ipv4_many and unpack_ipv4_many.
+
+Usage: python benchmark_conversion.py [addresses]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ip_anonymize_core
+
+
+def scalar_pack(addresses):
+    return [ip_anonymize_core.swap32(ip_anonymize_core.ip2long(a)) for a in addresses]
+
+def scalar_unpack(values):
+    return [ip_anonymize_core.long2ip(ip_anonymize_core.swap32(v)) for v in values]
+
+def run(name, function, argument, count):
+    start = time.time()
+    result = function(argument)
+    elapsed = time.time() - start
+    print("%-18s %8.3fs %8.3f us/address" % (name, elapsed, 1e6 * elapsed / count))
+    return result
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(0)
+    addresses = [ip_anonymize_core.long2ip(rng.getrandbits(32)) for _ in range(count)]
+
+    expected = run('scalar pack', scalar_pack, addresses, count)
+    packed = run('pack_ipv4_many', ip_anonymize_core.pack_ipv4_many, addresses, count)
+    if list(packed) != expected:
+        print("Packed values differ")
+        sys.exit(1)
+
+    expected = run('scalar unpack', scalar_unpack, expected, count)
+    unpacked = run('unpack_ipv4_many', ip_anonymize_core.unpack_ipv4_many, packed, count)
+    if unpacked != expected or unpacked != addresses:
+        print("Unpacked addresses differ")
+        sys.exit(1)
+    print("Conversions are identical")
+
+if __name__ == "__main__":
+    main()
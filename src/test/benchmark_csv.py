@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+This module compares the old csv.DictReader/csv.DictWriter
+row loop against the positional record loop used by the
+anonymization script, without the cryptopANT library.
+
+Usage: python benchmark_csv.py [rows]
+"""
+
+import csv
+import io
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ip_anonymize_core
+
+FIELDS = ['id_orig_h', 'id_resp_h', 'ip_1_anon', 'ip_2_anon']
+FIELD_PAIRS = [('id_orig_h', 'ip_1_anon'), ('id_resp_h', 'ip_2_anon')]
+BATCH_SIZE = ip_anonymize_core.DEFAULT_BATCH_SIZE
+
+
+def generate_input(rows):
+    """
+    Return a lookup table with rows of random addresses drawn
+    from a small pool, like connection logs
+
+    :param rows: int Number of data rows
+
+    :return: string CSV text
+    """
+    rng = random.Random(0)
+    pool = ['10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+            for _ in range(50000)]
+    buf = ip_anonymize_core.csv_body_writer()
+    w = csv.writer(buf)
+    w.writerow(FIELDS)
+    for _ in range(rows):
+        w.writerow([rng.choice(pool), rng.choice(pool), '', ''])
+    return buf.getvalue()
+
+def anonymize_many(addresses):
+    return [address[::-1] for address in addresses]
+
+def open_text(text):
+    if sys.version_info[0] >= 3:
+        return io.StringIO(text, newline='')
+    return io.BytesIO(text)
+
+def dict_loop(infile, outfile):
+    """
+    The row loop as it was before the positional rewrite
+    """
+    r = csv.DictReader(infile)
+    w = csv.DictWriter(outfile, fieldnames=r.fieldnames)
+    w.writeheader()
+    while True:
+        rows = list(itertools.islice(r, BATCH_SIZE))
+        if not rows:
+            return
+        addresses = [row[ip_field] for row in rows
+                     for ip_field, _ in FIELD_PAIRS if row[ip_field]]
+        anonymized = ip_anonymize_core.anonymize_distinct(addresses, anonymize_many)
+        for row in rows:
+            for ip_field, anon_field in FIELD_PAIRS:
+                if row[ip_field]:
+                    row[anon_field] = anonymized[row[ip_field]]
+        w.writerows(rows)
+
+def positional_loop(infile, outfile):
+    """
+    The row loop of ip_anonymize_core.main
+    """
+    reader = csv.reader(infile)
+    fieldnames = next(reader)
+    index_pairs = ip_anonymize_core.resolve_field_indices(fieldnames, FIELD_PAIRS)
+    records = ip_anonymize_core.iter_records(reader, len(fieldnames))
+    w = csv.writer(outfile)
+    w.writerow(fieldnames)
+    while True:
+        rows = list(itertools.islice(records, BATCH_SIZE))
+        if not rows:
+            return
+        ip_anonymize_core.anonymize_records(rows, index_pairs, anonymize_many)
+        w.writerows(rows)
+
+def run(loop, text, rows):
+    outfile = ip_anonymize_core.csv_body_writer()
+    start = time.time()
+    loop(open_text(text), outfile)
+    elapsed = time.time() - start
+    print("%-16s %8.2fs %12.0f rows/s" % (loop.__name__, elapsed, rows / elapsed))
+    return outfile.getvalue()
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    text = generate_input(rows)
+    expected = run(dict_loop, text, rows)
+    result = run(positional_loop, text, rows)
+    if result != expected:
+        print("Outputs differ")
+        sys.exit(1)
+    print("Outputs are identical")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""
+This module benchmarks the anonymization script on
+synthetic Zeek conn logs, both end to end through a
+subprocess and in-process, and writes the results as
+JSON so runs can be compared across versions.
+
+Usage: python benchmark_ip_anonymize.py /path/to/shared/library [options] [-- ip_anonymize.py options]
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__)) + "/"
+KEY_PATH = CUR_DIR + "test_key.key"
+ANONYMIZATION_SCRIPT_PATH = CUR_DIR + "../ip_anonymize.py"
+
+sys.path.insert(0, CUR_DIR + "..")
+
+import ip_anonymize_core
+
+CONN_FIELDS = ['ts', 'uid', 'id_orig_h', 'id_orig_p', 'id_resp_h', 'id_resp_p',
+               'proto', 'service', 'duration', 'orig_bytes', 'resp_bytes',
+               'conn_state', 'ip_1_anon', 'ip_2_anon']
+FIELD_PAIRS = [('id_orig_h', 'ip_1_anon'), ('id_resp_h', 'ip_2_anon')]
+
+
+class ZipfSampler(object):
+    """
+    Draw indices in range(n) with probability proportional
+    to 1 / (rank + 1) ** skew, a skew of 0 is uniform
+    """
+
+    def __init__(self, rng, n, skew):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(n):
+            total += 1.0 / (rank + 1) ** skew
+            self.cumulative.append(total)
+
+    def sample(self):
+        point = self.rng.random() * self.cumulative[-1]
+        return min(bisect.bisect_left(self.cumulative, point), len(self.cumulative) - 1)
+
+
+def generate_conn_log(path, rows, distinct, prefixes, skew, empty_rate, seed, ipv6_rate=0.0):
+    """
+    Write a synthetic Zeek conn log lookup table
+
+    :param path: string Path of the CSV file to write
+    :param rows: int Number of data rows
+    :param distinct: int Number of distinct addresses
+    :param prefixes: int Number of distinct /16 prefixes
+                    the addresses are spread over
+    :param skew: float Zipf exponent for both the popularity of
+                prefixes and of addresses
+    :param empty_rate: float Fraction of address fields left empty
+    :param seed: int Random seed
+    :param ipv6_rate: float Fraction of the distinct addresses which
+                    are IPv6, spread over /48 prefixes instead
+
+    :return: int Number of non empty address fields
+    """
+    rng = random.Random(seed)
+    prefix_pool = rng.sample(range(1 << 16), prefixes)
+    prefix_sampler = ZipfSampler(rng, prefixes, skew)
+    pool = set()
+    distinct_v6 = int(distinct * ipv6_rate)
+    while len(pool) < distinct - distinct_v6:
+        prefix = prefix_pool[prefix_sampler.sample()]
+        pool.add((prefix << 16) | rng.randint(1, 0xfffe))
+    pool = [ip_anonymize_core.long2ip(ip) for ip in sorted(pool)]
+    pool_v6 = set()
+    while len(pool_v6) < distinct_v6:
+        prefix = prefix_pool[prefix_sampler.sample()]
+        pool_v6.add('2001:db8:%x:%x::%x:%x' % (prefix, rng.getrandbits(16),
+                                                         rng.getrandbits(16), rng.getrandbits(16)))
+    pool.extend(sorted(pool_v6))
+    rng.shuffle(pool)
+    address_sampler = ZipfSampler(rng, distinct, skew)
+
+    addresses = 0
+    mode = 'w' if sys.version_info[0] >= 3 else 'wb'
+    kwargs = {'newline': ''} if sys.version_info[0] >= 3 else {}
+    with open(path, mode, **kwargs) as f:
+        w = csv.writer(f)
+        w.writerow(CONN_FIELDS)
+        ts = 1500000000.0
+        for i in range(rows):
+            ts += rng.random()
+            ips = []
+            for _ in range(2):
+                if rng.random() < empty_rate:
+                    ips.append('')
+                else:
+                    ips.append(pool[address_sampler.sample()])
+                    addresses += 1
+            w.writerow(['%.6f' % ts, 'C%017x' % i, ips[0], rng.randint(1024, 65535),
+                        ips[1], rng.choice((53, 80, 443, 22)), rng.choice(('tcp', 'udp')),
+                        '-', '%.6f' % rng.expovariate(1.0), rng.randint(0, 1 << 16),
+                        rng.randint(0, 1 << 20), rng.choice(('SF', 'S0', 'REJ')), '', ''])
+    return addresses
+
+def run_script(lib_path, input_path, options):
+    """
+    Run the anonymization script as Splunk would
+
+    :param lib_path: string Path to libcryptopANT
+    :param input_path: string Path of the lookup table to feed it
+    :param options: list of string ip_anonymize.py options
+
+    :return: tuple (seconds, peak RSS in KiB)
+    """
+    args = [sys.executable, ANONYMIZATION_SCRIPT_PATH] + options + [
+        KEY_PATH, lib_path, 'id_orig_h', 'id_resp_h', 'ip_1_anon', 'ip_2_anon']
+    with open(input_path) as stdin:
+        with open(os.devnull, 'w') as stdout:
+            start = time.time()
+            p = subprocess.Popen(args, stdin=stdin, stdout=stdout)
+            _, status, usage = os.wait4(p.pid, 0)
+            elapsed = time.time() - start
+    p.returncode = status
+    if status != 0:
+        raise RuntimeError("ip_anonymize.py exited with status %d" % status)
+    return elapsed, usage.ru_maxrss
+
+def run_in_process(lib_path, input_path, batch_size):
+    """
+    Time loading the library and anonymizing the lookup table
+    with the script's functions, without any CSV output
+
+    :param lib_path: string Path to libcryptopANT
+    :param input_path: string Path of the lookup table
+    :param batch_size: int Number of rows per anonymize call
+
+    :return: tuple (load seconds, anonymize seconds)
+    """
+    with open(input_path) as f:
+        reader = csv.reader(f)
+        fieldnames = next(reader)
+        records = list(ip_anonymize_core.iter_records(reader, len(fieldnames)))
+    index_pairs = ip_anonymize_core.resolve_field_indices(fieldnames, FIELD_PAIRS)
+
+    start = time.time()
+    anon_fun, table = ip_anonymize_core.setup_anonymize_fun(
+        lib_path, KEY_PATH, ip_anonymize_core.ScrambleAlgo.SCRAMBLE_BLOWFISH)
+    loaded = time.time()
+    cache = ip_anonymize_core.LRUCache(ip_anonymize_core.DEFAULT_CACHE_SIZE)
+    anonymize_many = lambda addresses: ip_anonymize_core.anonymize_ip_many(anon_fun, addresses, cache)
+    for i in range(0, len(records), batch_size):
+        ip_anonymize_core.anonymize_records(records[i:i + batch_size], index_pairs, anonymize_many)
+    done = time.time()
+    return loaded - start, done - loaded
+
+def best_of(repeat, function, *args):
+    results = [function(*args) for _ in range(repeat)]
+    return min(results, key=lambda result: result[0])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=CUR_DIR, stderr=open(os.devnull, 'w')).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous_path):
+    """
+    Print how each throughput and memory figure changed
+    against a previous results file
+    """
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print("Compared to %s (%s):" % (previous_path, previous.get('revision')))
+    for section in ('startup', 'end_to_end', 'in_process'):
+        for metric, value in sorted(results.get(section, {}).items()):
+            old = previous.get(section, {}).get(metric)
+            if old:
+                print("  %-10s %-16s %14.2f -> %14.2f (%+.1f%%)" % (
+                    section, metric, old, value, 100.0 * (value - old) / old))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark ip_anonymize.py on synthetic Zeek conn logs")
+    parser.add_argument('lib_path', help="Path to libcryptopANT")
+    parser.add_argument('--rows', type=int, default=1000000, help="Number of rows (default: %(default)s)")
+    parser.add_argument('--distinct', type=int, default=100000,
+                        help="Number of distinct addresses (default: %(default)s)")
+    parser.add_argument('--prefixes', type=int, default=256,
+                        help="Number of /16 prefixes the addresses share (default: %(default)s)")
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="Zipf exponent of prefix and address popularity, 0 is uniform (default: %(default)s)")
+    parser.add_argument('--empty-rate', type=float, default=0.05,
+                        help="Fraction of empty address fields (default: %(default)s)")
+    parser.add_argument('--ipv6-rate', type=float, default=0.0,
+                        help="Fraction of distinct addresses which are IPv6 (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="Keep the best of this many runs (default: %(default)s)")
+    parser.add_argument('--no-in-process', action='store_true', help="Skip the in-process run")
+    parser.add_argument('--input', help="Reuse this lookup table instead of generating one")
+    parser.add_argument('--output', help="Write the JSON results to this file")
+    parser.add_argument('--compare', help="Previous JSON results to compare against")
+    # Everything after -- is passed on to ip_anonymize.py
+    options = []
+    if '--' in argv:
+        options = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.options = options
+    if args.distinct > args.prefixes * 0xfffe:
+        parser.error("--distinct does not fit in --prefixes")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    params = dict((k, getattr(args, k)) for k in
+                  ('rows', 'distinct', 'prefixes', 'skew', 'empty_rate', 'ipv6_rate', 'seed', 'repeat',
+                   'options'))
+
+    input_path = args.input
+    tmp_dir = None
+    if input_path is None:
+        tmp_dir = tempfile.mkdtemp()
+        input_path = os.path.join(tmp_dir, 'conn.csv')
+        print("Generating %d rows" % args.rows)
+        addresses = generate_conn_log(input_path, args.rows, args.distinct, args.prefixes,
+                                      args.skew, args.empty_rate, args.seed, args.ipv6_rate)
+    else:
+        with open(input_path) as f:
+            reader = csv.DictReader(f)
+            rows = addresses = 0
+            for row in reader:
+                rows += 1
+                addresses += sum(1 for ip_field, _ in FIELD_PAIRS if row[ip_field])
+        params['rows'] = args.rows = rows
+        params['input'] = input_path
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'addresses': addresses,
+    }
+
+    try:
+        # A lookup table without data rows only pays for
+        # interpreter start, imports and loading the library
+        header_path = input_path + '.header'
+        with open(input_path) as f:
+            with open(header_path, 'w') as header:
+                header.write(f.readline())
+        seconds, rss = best_of(args.repeat, run_script, args.lib_path, header_path, args.options)
+        results['startup'] = {'seconds': seconds, 'peak_rss_kb': rss}
+        os.remove(header_path)
+
+        seconds, rss = best_of(args.repeat, run_script, args.lib_path, input_path, args.options)
+        results['end_to_end'] = {
+            'seconds': seconds,
+            'peak_rss_kb': rss,
+            'rows_per_s': args.rows / seconds,
+            'us_per_address': 1e6 * seconds / max(addresses, 1),
+        }
+
+        if not args.no_in_process:
+            load, seconds = best_of(args.repeat, run_in_process, args.lib_path, input_path,
+                                    ip_anonymize_core.DEFAULT_BATCH_SIZE)
+            results['in_process'] = {
+                'load_seconds': load,
+                'seconds': seconds,
+                'rows_per_s': args.rows / seconds,
+                'us_per_address': 1e6 * seconds / max(addresses, 1),
+                # Includes the parsed lookup table held in memory
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
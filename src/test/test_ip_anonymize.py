@@ -13,8 +13,14 @@ import socket
 import struct
 import os
 import csv
+import ctypes
+import gzip
+import json
 import sys
 import subprocess
+import shutil
+import tempfile
+import time
 
 
 
@@ -32,16 +38,33 @@ def ip2long(ip_str):
     """
     return struct.unpack("!L", socket.inet_aton(ip_str))[0]
 
-def common_prefix_len(ip_a, ip_b):
-    return 32 - (ip_a ^ ip_b).bit_length()
+def ip6long(ip_str):
+    """
+    Return the numerical representation of an IPv6 address string
+
+    :param ip_str: string IPv6 Address
+
+    :return: int Numerical Representation of IPv6 address
+
+    .. warning:: Raises socket.error for invalid strings
+    """
+    high, low = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip_str))
+    return (high << 64) | low
+
+def common_prefix_len(ip_a, ip_b, width=32):
+    return width - (ip_a ^ ip_b).bit_length()
 
 def check_prefix_preservation(ip_a, ip_b, anon_a, anon_b):
     return common_prefix_len(ip2long(ip_a), ip2long(ip_b)) == common_prefix_len(ip2long(anon_a), ip2long(anon_b))
 
+def check_prefix_preservation6(ip_a, ip_b, anon_a, anon_b):
+    return (common_prefix_len(ip6long(ip_a), ip6long(ip_b), 128) ==
+            common_prefix_len(ip6long(anon_a), ip6long(anon_b), 128))
+
 def main():
 
-    if len(sys.argv) != 2:
-        print("Usage: python test_ip_anonymize.py /path/to/shared/library")
+    if len(sys.argv) < 2:
+        print("Usage: python test_ip_anonymize.py /path/to/shared/library [ip_anonymize.py options]")
         sys.exit(1)
 
 
@@ -50,10 +73,11 @@ def main():
     REFERENCE_OUTPUT_PATH = CUR_DIR + "test_output.csv"
     KEY_PATH = CUR_DIR +  "test_key.key"
     LIB_PATH = sys.argv[1]
+    SCRIPT_OPTIONS = sys.argv[2:]
     ANONYMIZATION_SCRIPT_PATH = CUR_DIR + "../ip_anonymize.py"
     SCRIPT_ARGS = [
-        "python",
-        ANONYMIZATION_SCRIPT_PATH,
+        sys.executable,
+        ANONYMIZATION_SCRIPT_PATH] + SCRIPT_OPTIONS + [
         KEY_PATH,
         LIB_PATH,
         "id_orig_h",
@@ -69,7 +93,8 @@ def main():
 
     try:
         with open(TEST_INPUT_PATH) as f:
-            p = subprocess.Popen(SCRIPT_ARGS, stdin=f, stdout=subprocess.PIPE)
+            p = subprocess.Popen(SCRIPT_ARGS, stdin=f, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
             output_generated = [r for r in csv.DictReader(p.stdout)]
             if p.returncode == 1:
                 print("Anonymization Script Exited with Status code 1. Check Logs.")
@@ -86,7 +111,7 @@ def main():
         if not check_prefix_preservation(gen['id_orig_h'], gen['id_resp_h'], gen['ip_1_anon'], gen['ip_2_anon']):
             print("Prefix not preserved for line: %s" % (str(gen)))
             assert(False)
-    print("Tests 1/2 Passed!")
+    print("Tests 1/13 Passed!")
 
     # Match generated output with reference
     print("Test 2: Checking against reference output")
@@ -104,7 +129,313 @@ def main():
                 print("Mismatching Fields: %s != %s" % (v, ref[k]))
                 assert(False)
     
-    print("Tests 2/2 Passed!")
+    print("Tests 2/13 Passed!")
+
+    # The same pairs listed in another order must give the same output
+    print("Test 3: Checking field pairs given in another order")
+
+    SWAPPED_ARGS = SCRIPT_ARGS[:-4] + ["id_resp_h", "id_orig_h", "ip_2_anon", "ip_1_anon"]
+    with open(TEST_INPUT_PATH) as f:
+        p = subprocess.Popen(SWAPPED_ARGS, stdin=f, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        output_swapped = [r for r in csv.DictReader(p.stdout)]
+
+    if not output_swapped == output_generated:
+        print("Output differs when the field pairs are swapped")
+        assert(False)
+
+    print("Tests 3/13 Passed!")
+
+    # Values which are not addresses must not fail the lookup
+    print("Test 4: Checking rows with invalid addresses")
+
+    with open(TEST_INPUT_PATH) as f:
+        dirty_input = f.read() + "-,example.com,,\n"
+    p = subprocess.Popen(SCRIPT_ARGS, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    output_dirty = [r for r in csv.DictReader(p.communicate(dirty_input)[0].splitlines())]
+
+    if p.returncode != 0 or output_dirty[:-1] != output_generated:
+        print("Rows with invalid addresses changed the output")
+        assert(False)
+    if output_dirty[-1]['ip_1_anon'] or output_dirty[-1]['ip_2_anon']:
+        print("Invalid addresses were not blanked: %s" % str(output_dirty[-1]))
+        assert(False)
+
+    print("Tests 4/13 Passed!")
+
+    # Scrambling 24 bits keeps the last octet and the scrambled prefix
+    print("Test 5: Checking a scramble depth of 24 bits")
+
+    DEPTH_ARGS = SCRIPT_ARGS[:2] + ["--scramble-bits", "id_orig_h=24"] + SCRIPT_ARGS[2:]
+    with open(TEST_INPUT_PATH) as f:
+        p = subprocess.Popen(DEPTH_ARGS, stdin=f, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        output_depth = [r for r in csv.DictReader(p.stdout)]
+
+    if not len(output_depth) == len(output_generated):
+        print("Length of file does not match")
+        assert(False)
+    for depth, gen in zip(output_depth, output_generated):
+        if depth['ip_1_anon'].split('.')[3] != gen['id_orig_h'].split('.')[3]:
+            print("Last octet not kept for line: %s" % str(depth))
+            assert(False)
+        if depth['ip_1_anon'].split('.')[:3] != gen['ip_1_anon'].split('.')[:3]:
+            print("Prefix differs from the full scramble for line: %s" % str(depth))
+            assert(False)
+        if depth['ip_2_anon'] != gen['ip_2_anon']:
+            print("Scramble depth changed another field for line: %s" % str(depth))
+            assert(False)
+
+    print("Tests 5/13 Passed!")
+
+    # A passthrough policy must return the input unchanged
+    print("Test 6: Checking a passthrough policy")
+
+    fd, policy_path = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write("0.0.0.0/0 passthrough\n")
+        POLICY_ARGS = SCRIPT_ARGS[:2] + ["--policy", policy_path] + SCRIPT_ARGS[2:]
+        with open(TEST_INPUT_PATH) as f:
+            p = subprocess.Popen(POLICY_ARGS, stdin=f, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+            output_policy = [r for r in csv.DictReader(p.stdout)]
+    finally:
+        os.remove(policy_path)
+
+    if not len(output_policy) == len(output_generated):
+        print("Length of file does not match")
+        assert(False)
+    for gen in output_policy:
+        if gen['ip_1_anon'] != gen['id_orig_h'] or gen['ip_2_anon'] != gen['id_resp_h']:
+            print("Address not passed through for line: %s" % str(gen))
+            assert(False)
+
+    print("Tests 6/13 Passed!")
+
+    # A second run must be answered from the cache file the first
+    # filled, without loading the library at all
+    print("Test 7: Checking a persistent cache file")
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        CACHE_ARGS = SCRIPT_ARGS[:2] + ["--cache-file", os.path.join(cache_dir, "cache")] + SCRIPT_ARGS[2:]
+        WARM_ARGS = [os.path.join(cache_dir, "missing.so") if arg == LIB_PATH else arg
+                     for arg in CACHE_ARGS]
+        outputs_cached = []
+        for args in (CACHE_ARGS, WARM_ARGS):
+            with open(TEST_INPUT_PATH) as f:
+                p = subprocess.Popen(args, stdin=f, stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+                outputs_cached.append([r for r in csv.DictReader(p.stdout)])
+    finally:
+        shutil.rmtree(cache_dir)
+
+    for run, output_cached in zip(("cold", "warm"), outputs_cached):
+        if not output_cached == output_generated:
+            print("Output differs with a %s cache file" % run)
+            assert(False)
+
+    print("Tests 7/13 Passed!")
+
+    # Lookups given --daemon must be answered by a running daemon
+    print("Test 8: Checking the anonymization daemon")
+
+    daemon_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(daemon_dir, "daemon.sock")
+    metrics_path = os.path.join(daemon_dir, "metrics.json")
+    daemon = subprocess.Popen([sys.executable, ANONYMIZATION_SCRIPT_PATH, "serve",
+                               "--socket", socket_path, KEY_PATH, LIB_PATH])
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path) or daemon.poll() is not None:
+                break
+            time.sleep(0.1)
+        DAEMON_ARGS = SCRIPT_ARGS[:2] + ["--daemon", "--daemon-socket", socket_path,
+                                         "--metrics-json", metrics_path] + SCRIPT_ARGS[2:]
+        with open(TEST_INPUT_PATH) as f:
+            p = subprocess.Popen(DAEMON_ARGS, stdin=f, stdout=subprocess.PIPE,
+                                 universal_newlines=True)
+            output_daemon = [r for r in csv.DictReader(p.stdout)]
+        with open(metrics_path) as f:
+            metrics = json.loads(f.read())
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(daemon_dir)
+
+    if 'daemon' not in metrics['seconds']:
+        print("The lookup did not use the daemon")
+        assert(False)
+    if not output_daemon == output_generated:
+        print("Output differs when answered by the daemon")
+        assert(False)
+
+    print("Tests 8/13 Passed!")
+
+    # The chunked protocol must give the same results, split over
+    # several chunks of one search
+    print("Test 9: Checking the chunked search command protocol")
+
+    def chunk(metadata, body=b""):
+        metadata = json.dumps(metadata).encode("utf-8")
+        return ("chunked 1.0,%d,%d\n" % (len(metadata), len(body))).encode("ascii") + metadata + body
+
+    with open(TEST_INPUT_PATH, "rb") as f:
+        lines = f.read().splitlines(True)
+    half = len(lines) // 2
+    exchange = (chunk({"action": "getinfo", "searchinfo": {"args": [
+                    "id_orig_h", "AS", "ip_1_anon", "id_resp_h", "AS", "ip_2_anon"]}}) +
+                chunk({"action": "execute"}, b"".join(lines[:half])) +
+                chunk({"action": "execute", "finished": True}, b"".join(lines[:1] + lines[half:])))
+    p = subprocess.Popen([sys.executable, ANONYMIZATION_SCRIPT_PATH, "chunked", KEY_PATH, LIB_PATH],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    response = p.communicate(exchange)[0]
+
+    output_chunked = []
+    while response:
+        header, _, response = response.partition(b"\n")
+        metadata_length, body_length = [int(n) for n in header.split(b",")[1:]]
+        body = response[metadata_length:metadata_length + body_length]
+        response = response[metadata_length + body_length:]
+        output_chunked += [r for r in csv.DictReader(body.decode("utf-8").splitlines())]
+
+    if p.returncode != 0 or not len(output_chunked) == len(output_generated):
+        print("Chunked mode did not return every row")
+        assert(False)
+    for chunked, gen in zip(output_chunked, output_generated):
+        if chunked['ip_1_anon'] != gen['ip_1_anon'] or chunked['ip_2_anon'] != gen['ip_2_anon']:
+            print("Chunked mode output differs for line: %s" % str(chunked))
+            assert(False)
+
+    print("Tests 9/13 Passed!")
+
+    # IPv6 addresses must keep their common prefixes too, or be
+    # blanked if the library cannot scramble them
+    print("Test 10: Checking IPv6 addresses")
+
+    ipv6_pairs = [("2001:db8::1", "2001:db8::2"), ("2001:db8:0:1::5", "2001:db8:ffff::1"),
+                  ("fe80::1", "2001:db8::1"), ("2001:db8::1", "2001:db8::1"), ("::1", "::2")]
+    with open(TEST_INPUT_PATH) as f:
+        mixed_input = f.read() + "".join("%s,%s,,\n" % pair for pair in ipv6_pairs)
+    IPV6_ARGS = SCRIPT_ARGS[:-4] + ["--on-invalid", "blank"] + SCRIPT_ARGS[-4:]
+    p = subprocess.Popen(IPV6_ARGS, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    output_ipv6 = [r for r in csv.DictReader(p.communicate(mixed_input)[0].splitlines())]
+
+    if p.returncode != 0 or output_ipv6[:-len(ipv6_pairs)] != output_generated:
+        print("IPv6 rows changed the output of the IPv4 rows")
+        assert(False)
+    has_ipv6 = hasattr(ctypes.CDLL(LIB_PATH), "scramble_ip6")
+    for gen in output_ipv6[-len(ipv6_pairs):]:
+        if not has_ipv6:
+            if gen['ip_1_anon'] or gen['ip_2_anon']:
+                print("IPv6 addresses were not blanked without scramble_ip6: %s" % str(gen))
+                assert(False)
+        elif not check_prefix_preservation6(gen['id_orig_h'], gen['id_resp_h'],
+                                            gen['ip_1_anon'], gen['ip_2_anon']):
+            print("Prefix not preserved for line: %s" % (str(gen)))
+            assert(False)
+
+    print("Tests 10/13 Passed!")
+
+    # Updating a table cut short by an interrupted run must drop the
+    # partial row and still add its address
+    print("Test 11: Checking a table update after an interrupted run")
+
+    table_dir = tempfile.mkdtemp()
+    try:
+        table_path = os.path.join(table_dir, "table.csv")
+        TABLE_ARGS = [sys.executable, ANONYMIZATION_SCRIPT_PATH, "table", KEY_PATH, LIB_PATH,
+                      "--output", table_path]
+        subprocess.check_call(TABLE_ARGS + ["--cidr", "10.0.0.0/30"])
+        with open(table_path, "a") as f:
+            f.write("10.0.0.5,1")
+        subprocess.check_call(TABLE_ARGS + ["--cidr", "10.0.0.0/29", "--update"])
+        with open(table_path) as f:
+            table = dict((r['ip'], r['ip_anon']) for r in csv.DictReader(f))
+            f.seek(0)
+            table_rows = len(f.readlines()) - 1
+    finally:
+        shutil.rmtree(table_dir)
+
+    table_input = "id_orig_h,id_resp_h,ip_1_anon,ip_2_anon\n" + "".join(
+        "10.0.0.%d,10.0.0.%d,,\n" % (i, i) for i in range(8))
+    p = subprocess.Popen(SCRIPT_ARGS, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         universal_newlines=True)
+    output_table = [r for r in csv.DictReader(p.communicate(table_input)[0].splitlines())]
+
+    if table_rows != 8 or sorted(table) != sorted(r['id_orig_h'] for r in output_table):
+        print("Table does not hold every address once: %s" % str(sorted(table)))
+        assert(False)
+    for gen in output_table:
+        if table[gen['id_orig_h']] != gen['ip_1_anon']:
+            print("Table differs from the lookup for line: %s" % str(gen))
+            assert(False)
+
+    print("Tests 11/13 Passed!")
+
+    # Reversing the pseudonyms must give back the addresses, given
+    # the same scramble depths as the lookup which produced them
+    print("Test 12: Checking de-anonymization")
+
+    if not hasattr(ctypes.CDLL(LIB_PATH), "unscramble_ip4"):
+        print("The library has no unscramble_ip4, skipped")
+    else:
+        audit_dir = tempfile.mkdtemp()
+        try:
+            REVERSE_ARGS = [sys.executable, ANONYMIZATION_SCRIPT_PATH, "reverse", KEY_PATH, LIB_PATH,
+                            "--reason", "test", "--audit-log", os.path.join(audit_dir, "audit.log")]
+            for options in ([], ["--scramble-bits", "0.0.0.0/0=24"]):
+                with open(TEST_INPUT_PATH) as f:
+                    p = subprocess.Popen(SCRIPT_ARGS[:2] + options + SCRIPT_ARGS[2:], stdin=f,
+                                         stdout=subprocess.PIPE, universal_newlines=True)
+                    output = [r for r in csv.DictReader(p.stdout)]
+                addresses = dict((gen['ip_1_anon'], gen['id_orig_h']) for gen in output)
+                addresses.update((gen['ip_2_anon'], gen['id_resp_h']) for gen in output)
+                p = subprocess.Popen(REVERSE_ARGS + options, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, universal_newlines=True)
+                reverse = dict((r['ip_anon'], r['ip']) for r in csv.DictReader(
+                    p.communicate("".join("%s\n" % a for a in addresses))[0].splitlines()))
+                if not reverse == addresses:
+                    print("Pseudonyms not mapped back to their addresses with options %s" % options)
+                    assert(False)
+        finally:
+            shutil.rmtree(audit_dir)
+
+    print("Tests 12/13 Passed!")
+
+    # A compressed Zeek log must come out with the same pseudonyms as
+    # the lookup and with its comment lines where they were
+    print("Test 13: Checking bulk anonymization of a Zeek log")
+
+    bulk_dir = tempfile.mkdtemp()
+    try:
+        zeek_lines = ["#separator \\x09", "#fields\tts\tid.orig_h\tid.resp_h",
+                      "#types\ttime\taddr\taddr"]
+        zeek_lines += ["%d\t%s\t%s" % (i, gen['id_orig_h'], gen['id_resp_h'])
+                       for i, gen in enumerate(output_generated)]
+        zeek_lines.append("#close\t2020-06-01-00-00-00")
+        with gzip.open(os.path.join(bulk_dir, "conn.log.gz"), "wb") as f:
+            f.write(("\n".join(zeek_lines) + "\n").encode("utf-8"))
+        subprocess.check_call([sys.executable, ANONYMIZATION_SCRIPT_PATH, "bulk", KEY_PATH, LIB_PATH,
+                               bulk_dir, "--workers", "1", "--batch-size", "7"])
+        with gzip.open(os.path.join(bulk_dir, "conn.anon.log.gz"), "rb") as f:
+            bulk_lines = f.read().decode("utf-8").splitlines()
+    finally:
+        shutil.rmtree(bulk_dir)
+
+    if not len(bulk_lines) == len(zeek_lines) or bulk_lines[:3] != zeek_lines[:3] or \
+            bulk_lines[-1] != zeek_lines[-1]:
+        print("Comment lines of the Zeek log moved or changed")
+        assert(False)
+    for line, gen in zip(bulk_lines[3:-1], output_generated):
+        if line.split("\t")[1:] != [gen['ip_1_anon'], gen['ip_2_anon']]:
+            print("Bulk output differs for line: %s" % line)
+            assert(False)
+
+    print("Tests 13/13 Passed!")
 
 
 if __name__ == "__main__":